@@ -0,0 +1,248 @@
+"""
+benchmark of the model layers (eager, forward only) and of the compiled models
+
+    python benchmark.py [layer] [device] [seconds]
+        [layer]: 'complex_conv', 'complex_lstm', 'stft', 'compile', 'norms'
+        [device]: 'cpu' (default), 'cuda'
+        [seconds]: length of the input wav (default 4)
+"""
+import sys
+import time
+import torch
+import config as cfg
+import tools_for_model as tools
+from models import DCCRN, CRN, FullSubNet
+from tools_for_model import ConvSTFT, ConviSTFT, ComplexConv2d, ComplexConvTranspose2d, NavieComplexLSTM, \
+    forgetting_mean, forgetting_mean_loop
+
+
+def timeit(fn, device, repeat=20, warmup=3, grad=False):
+    # ms per call
+    with torch.set_grad_enabled(grad):
+        for _ in range(warmup):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        st_time = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - st_time) / repeat * 1000
+
+
+def layer_inputs(model, layer_types, inputs):
+    # the input of every layer of the types, from one forward of the model
+    layers = []
+
+    def hook(module, args):
+        layers.append((module, args))
+
+    handles = [module.register_forward_pre_hook(hook) for module in model.modules()
+               if isinstance(module, layer_types)]
+    with torch.no_grad():
+        model(inputs)
+    for handle in handles:
+        handle.remove()
+    return layers
+
+
+def max_diff(ref, out):
+    if isinstance(ref, (tuple, list)):
+        return max(max_diff(r, o) for r, o in zip(ref, out))
+    return (ref - out).abs().max().item()
+
+
+def assert_close(name, ref, out, rtol, atol):
+    # raises (non-zero exit) if the output of the optimized path is not the reference one
+    for r, o in zip(ref, out) if isinstance(ref, (tuple, list)) else ((ref, out),):
+        torch.testing.assert_close(o, r, rtol=rtol, atol=atol, msg=lambda msg: '{}: {}'.format(name, msg))
+
+
+def print_header(name, before, after):
+    print('{:<34} {:>10} {:>10} {:>9} {:>10}'.format(name, before, after, 'speedup', 'max diff'))
+
+
+def print_row(name, before_ms, after_ms, diff):
+    print('{:<34} {:>10.3f} {:>10.3f} {:>8.2f}x {:>10.2e}'.format(name, before_ms, after_ms, before_ms / after_ms,
+                                                                  diff))
+
+
+def compare(name, layer, inputs, attribute, device, before=False, after=True, rtol=1e-5, atol=1e-5):
+    # layer.attribute = before vs after, asserts the outputs are the same within rtol / atol
+    with torch.no_grad():
+        setattr(layer, attribute, before)
+        ref = layer(*inputs)
+        before_ms = timeit(lambda: layer(*inputs), device)
+        setattr(layer, attribute, after)
+        out = layer(*inputs)
+        after_ms = timeit(lambda: layer(*inputs), device)
+    print_row(name, before_ms, after_ms, max_diff(ref, out))
+    assert_close(name, ref, out, rtol, atol)
+
+
+def complex_conv(device, seconds):
+    """the 4 convolutions vs the fused one, for each ComplexConv2d / ComplexConvTranspose2d of DCCRN"""
+    model = DCCRN().to(device).eval()
+    inputs = torch.randn(1, int(seconds * cfg.fs), device=device)
+
+    print_header('layer (input shape)', '4 conv ms', 'fused ms')
+    for layer, args in layer_inputs(model, (ComplexConv2d, ComplexConvTranspose2d), inputs):
+        name = '{} {}'.format('enc' if isinstance(layer, ComplexConv2d) else 'dec', list(args[0].shape))
+        compare(name, layer, args, 'fused', device, rtol=1e-4, atol=1e-4)  # other summation order of the products
+
+
+def complex_lstm(device, seconds):
+    """4 LSTM calls vs 2 calls on the real and imag batch, for each NavieComplexLSTM of DCCRN"""
+    model = DCCRN(lstm='complex').to(device).eval()
+    inputs = torch.randn(1, int(seconds * cfg.fs), device=device)
+
+    print_header('layer (input shape)', '4 lstm ms', 'batched ms')
+    for idx, (layer, args) in enumerate(layer_inputs(model, NavieComplexLSTM, inputs)):
+        name = 'lstm{} {}'.format(idx, list(args[0].shape))
+        compare(name, layer, args, 'batched', device)
+
+
+def stft(device, seconds):
+    """conv vs fft backend of ConvSTFT / ConviSTFT (DCCRN setting)"""
+    stft = ConvSTFT(cfg.win_len, cfg.win_inc, cfg.fft_len, cfg.window, 'complex', backend='fft').to(device)
+    istft = ConviSTFT(cfg.win_len, cfg.win_inc, cfg.fft_len, cfg.window, 'complex', backend='fft').to(device)
+    inputs = torch.randn(4, int(seconds * cfg.fs), device=device)
+    with torch.no_grad():
+        specs = stft(inputs)
+
+    print_header('layer (input shape)', 'conv ms', 'fft ms')
+    compare('stft {}'.format(list(inputs.shape)), stft, (inputs,), 'backend', device, 'conv', 'fft')
+    compare('istft {}'.format(list(specs.shape)), istft, (specs,), 'backend', device, 'conv', 'fft')
+
+
+def model_inputs(name, device, seconds):
+    # the inputs of the forward of each model (as in trainer.py)
+    inputs = torch.randn(1, int(seconds * cfg.fs), device=device)
+    if name == 'FullSubNet':
+        noisy_mag, _ = tools.mag_phase(tools.stft(inputs))
+        return (noisy_mag,)
+    return (inputs,)
+
+
+def train_step(model, inputs):
+    # forward and backward, returns the output and the gradients
+    model.zero_grad(set_to_none=True)
+    outputs = model(*inputs)
+    outputs = outputs[-1] if isinstance(outputs, tuple) else outputs
+    outputs.pow(2).mean().backward()
+    return [outputs.detach()] + [param.grad for param in model.parameters() if param.grad is not None]
+
+
+# tolerance of the compiled models (rtol, atol): the same ops for script, other kernels (fused, reordered) for compile
+SCRIPT_TOL = (1e-5, 1e-5)
+COMPILE_TOL = (1e-3, 1e-3)
+
+
+def compile_models(device, seconds):
+    """
+    eager vs torch.jit.script and torch.compile of each model: the inference and the training step
+    (asserts the compiled outputs and gradients equal the eager ones, within SCRIPT_TOL / COMPILE_TOL)
+    """
+    print_header('model (mode)', 'eager ms', 'comp. ms')
+    for name, model_class in (('DCCRN', DCCRN), ('CRN', CRN), ('FullSubNet', FullSubNet)):
+        model = model_class().to(device)
+        inputs = model_inputs(name, device, seconds)
+
+        # the dropout of the RNNs (FullSubNet) is turned off: the compiled model draws other random numbers
+        for module in model.modules():
+            if isinstance(module, torch.nn.RNNBase):
+                module.dropout = 0.
+
+        # inference: one graph for the whole model, the RNNs are unrolled for the length of the input
+        # (dynamo breaks the graph at every nn.LSTM / nn.GRU without allow_rnn)
+        model.eval()
+        scripted = torch.jit.script(model)
+        compiled = torch.compile(model)
+        with torch.no_grad(), torch._dynamo.config.patch(allow_rnn=True):
+            ref = model(*inputs)
+            eager_ms = timeit(lambda: model(*inputs), device)
+            for mode, compiled_model, tol in (('script', scripted, SCRIPT_TOL), ('compile', compiled, COMPILE_TOL)):
+                out = compiled_model(*inputs)
+                compiled_ms = timeit(lambda: compiled_model(*inputs), device)
+                row = '{} ({}, inference)'.format(name, mode)
+                print_row(row, eager_ms, compiled_ms, max_diff(ref, out))
+                assert_close(row, ref, out, *tol)
+
+        # training: as trainer.compile_model (the backward of the unrolled RNNs takes too long to compile)
+        torch._dynamo.reset()
+        model.train()
+        compiled = torch.compile(model)
+        ref = train_step(model, inputs)
+        eager_ms = timeit(lambda: train_step(model, inputs), device, grad=True)
+        out = train_step(compiled, inputs)
+        compiled_ms = timeit(lambda: train_step(compiled, inputs), device, grad=True)
+        row = '{} (compile, training)'.format(name)
+        print_row(row, eager_ms, compiled_ms, max_diff(ref, out))
+        assert_close(row, ref, out, *COMPILE_TOL)
+
+
+# tolerance of forgetting_mean relative to the loop (rtol, atol), by dtype
+NORM_TOL = {torch.float32: (1e-5, 1e-6), torch.float64: (1e-6, 1e-9)}
+
+
+def norms(device, seconds, sample_length_in_training=192, steady_frames=4 * 64):
+    """
+    the loop over the frames vs forgetting_mean, the running mean of the forgetting norms of BaseModel
+    (max diff: relative to the loop), in fp32 and fp64, asserted within NORM_TOL
+    the input is repeated to have at least steady_frames after the warm-up: several blocks of exponential_smoothing
+    """
+    inputs = torch.randn(2, int(seconds * cfg.fs), device=device)
+    mags, _ = tools.mag_phase(tools.stft(inputs))  # [B, F, T]
+    mags = mags.reshape(mags.size(0), -1, mags.size(-1))
+    num_freqs, num_frames = mags.size(1), mags.size(-1)
+    mags = mags.repeat(1, 1, -(-(sample_length_in_training + steady_frames) // num_frames))
+    assert mags.size(-1) >= sample_length_in_training + steady_frames
+
+    print_header('norm {}'.format(list(mags.shape)), 'loop ms', 'vector ms')
+    for dtype in (torch.float32, torch.float64):
+        mags = mags.to(dtype)
+        mean = torch.mean(mags, dim=1)
+        cases = (
+            ('forgetting_norm', mean, None),
+            ('sband_forgetting_norm', mean, mags[:, num_freqs // 2 - 1, :]),
+            ('hybrid_norm (warm-up)', mean[:, :sample_length_in_training], None),
+        )
+        for name, input, steady_input in cases:
+            args = (input, sample_length_in_training, steady_input)
+            with torch.no_grad():
+                ref = forgetting_mean_loop(*args)
+                out = forgetting_mean(*args)
+                loop_ms = timeit(lambda: forgetting_mean_loop(*args), device, repeat=3)
+                vector_ms = timeit(lambda: forgetting_mean(*args), device)
+            name = '{} {}'.format(name, str(dtype)[6:])
+            print_row(name, loop_ms, vector_ms, max_diff(torch.ones_like(ref), out / ref))
+            assert_close(name, ref, out, *NORM_TOL[dtype])
+
+
+BENCHMARKS = {
+    'complex_conv': complex_conv,
+    'complex_lstm': complex_lstm,
+    'stft': stft,
+    'compile': compile_models,
+    'norms': norms,
+}
+
+
+def main():
+    argvs = sys.argv[1:]
+    if len(argvs) < 1 or argvs[0] not in BENCHMARKS:
+        print('Error: Invalid input arguments')
+        print('\t Usage: python benchmark.py [layer] [device] [seconds]')
+        print('\t\t [layer]: {}'.format(', '.join(BENCHMARKS)))
+        print("\t\t [device]: 'cpu' (default), 'cuda'")
+        print('\t\t [seconds]: length of the input wav (default 4)')
+        exit()
+    device = torch.device(argvs[1] if len(argvs) > 1 else 'cpu')
+    seconds = float(argvs[2]) if len(argvs) > 2 else 4.
+
+    BENCHMARKS[argvs[0]](device, seconds)
+
+
+if __name__ == '__main__':
+    main()
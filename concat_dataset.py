@@ -0,0 +1,29 @@
+"""
+concatenate datasets (e.g. ori + shifting + minus + reverse)
+
+The new dataset only points to the shards of the given datasets, so nothing is loaded or copied.
+If the output dataset already exists, the given datasets are appended to it.
+Legacy .npy files are converted into shards of the output dataset.
+
+    python concat_dataset.py './Dataset/train_shifting+minus+reverse+ori_data' \
+        './Dataset/train_dataset_norm_tv31_snr51015' './Dataset/train_dataset_norm_tv31_snr51015_shifting' \
+        './Dataset/train_dataset_norm_tv31_snr51015_minus' './Dataset/train_dataset_norm_tv31_snr51015_reverse'
+"""
+import sys
+from tools_for_dataset import merge_datasets, load_pairs
+
+
+def main():
+    argvs = sys.argv[1:]
+    if len(argvs) < 2:
+        print('Error: Invalid input arguments')
+        print('\t Usage: python concat_dataset.py [output_dir] [dataset] [dataset] ...')
+        print("\t\t [output_dir]: './Dataset/train_shifting+minus+reverse+ori_data', ...")
+        print("\t\t [dataset]: sharded dataset directory or legacy '.npy' file")
+        exit()
+    manifest = merge_datasets(argvs[0], argvs[1:])
+    print('{} shards, {} pairs'.format(len(manifest['shards']), len(load_pairs(argvs[0]))))
+
+
+if __name__ == '__main__':
+    main()
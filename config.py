@@ -44,9 +44,58 @@ skip_type = True   # False, if you want to remove 'skip connection'
 # hyper-parameters
 max_epochs = 100
 learning_rate = 0.001
-batch = 10
+batch = 10  # the optimization batch
+micro_batch = None  # the batch loaded at once (gradient accumulation if smaller than batch, None: same as batch)
+if micro_batch is None:
+    micro_batch = batch
+assert batch % micro_batch == 0, "batch must be a multiple of micro_batch"
+accumulation_steps = batch // micro_batch
+
+# mixed precision training (autocast + gradient scaler), the STFT/iSTFT and the losses stay in fp32
+amp = False
+amp_dtype = 'float16'  # 'float16' (cuda) or 'bfloat16' (cpu, or the GPUs supporting it)
+# distributed data-parallel training, launched by torchrun (see tools_for_distributed.py)
+dist_backend = 'nccl'  # 'nccl' (GPUs) or 'gloo' (CPUs)
+sync_bn = False  # convert the BatchNorm layers to SyncBatchNorm (GPUs only)
+# torch.compile the model for the training and validation: opt-in, it does not pay off for every model
+# (cpu: no gain for DCCRN, CRN faster or slower from run to run), measure it with 'python benchmark.py compile'
+torch_compile = False
+
+# data loading
+num_workers = 4  # 0: load the data in the main process
+prefetch_factor = 2  # batches loaded in advance by each worker
+persistent_workers = True  # keep the workers alive between epochs
+pin_memory = True  # with non_blocking copy, the host-to-device copy overlaps the computation
+# length bucketing for the variable-length data: the samples of a batch have similar lengths,
+# the batch is padded to the longest one and the padding is masked out of the loss
+bucketing = False
+bucket_batches = 100  # number of batches sorted by length together
+# random fixed-length crop of the training utterances (seconds, None: the whole utterance)
+# the length is aligned to win_inc (to whole seconds with the PMSQE loss, see dataloader.length_multiple),
+# and only the window is read from a sharded dataset
+crop_sec = None
+
+# on-the-fly mixture: mix the clean and noise corpora (made by wav_to_corpus.py) in the dataloader
+# instead of loading the pre-generated noisy training data
+mixture = False
+mixture_clean_path = './Dataset/train_clean_corpus'
+mixture_noise_path = './Dataset/train_noise_corpus'
+mixture_snr = [5, 10, 15]
+mixture_sec = 3  # length of each mixture
+mixture_num = None  # mixtures per epoch (None: number of clean files * number of SNRs)
+mixture_seed = 0  # the mixtures of an epoch only depend on (mixture_seed, epoch, index)
+
+# augmentation of the training batches (see tools_for_augmentation.py)
+# probability of each transform for each sample, 0 if you don't want to use it
+augmentation = {'minus': 0., 'shift': 0., 'reverse': 0., 'gain': 0., 'snr_jitter': 0.}
+shift_range = [0., 1.]  # rate of the length
+gain_range = [-6., 0.]  # dB
+snr_jitter_range = [-5., 5.]  # dB
+augment_on_device = False  # True: augment on DEVICE in the trainer, False: in the dataloader workers
 # kernel size
 dccrn_kernel_num = [32, 64, 128, 256, 256, 256]
+# True: no decoder layer looks one frame ahead (needed for the streaming inference, models.DCCRNStreamer)
+dccrn_causal = False
 #######################################################################
 #                         model information                           #
 #######################################################################
@@ -58,6 +107,7 @@ fft_len = 512
 sam_sec = fft_len / fs
 frm_samp = fs * (fft_len / fs)
 window = 'hanning'
+stft_backend = 'conv'  # STFT of DCCRN and CRN, 'conv': conv1d with the DFT kernel, 'fft': torch.fft
 
 # for DCCRN
 rnn_layers = 2
@@ -77,6 +127,9 @@ fb_model_hidden_size = 512
 sb_model_hidden_size = 384
 weight_init = False
 norm_type = "offline_laplace_norm"
+sb_chunk_size = None  # number of freqs in the sub-band model at once (None: all), less memory in the training
+sb_inference_chunk_size = None  # the same for the validation / inference (eval mode), e.g. 32 for long recordings
+sb_freq_ratio = 1.  # rate of the random freqs of the sub-band model in training (1: all), e.g. 1/3: about 1/3 of the cost
 num_groups_in_drop_band = 2
 #######################################################################
 #                      setting error check                            #
@@ -101,6 +154,8 @@ if model != 'FullSubNet':
 else:
     print('Main network : {}'.format(sequence_model))
 print('\nBATCH : {}'.format(batch))
+if accumulation_steps > 1:
+    print('MICRO BATCH : {} (accumulation of {} steps)'.format(micro_batch, accumulation_steps))
 print('LEARNING RATE : {}'.format(learning_rate))
 print('--------------------------------------------------------------')
 print('--------------------------------------------------------------\n')
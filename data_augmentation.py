@@ -1,3 +1,9 @@
+"""
+write augmented copies of the clean data
+
+For the training, the same augmentations can be done on the batches without writing any file
+(config.augmentation, see tools_for_augmentation.py).
+"""
 import os
 import numpy as np
 import librosa
@@ -49,7 +55,7 @@ def minus_sound(data, sr=22050):
 # Reverse the sound
 def reverse_sound(data, sr=22050):
     # 거꾸로 재생
-    data = np.array([data[len(data) - 1 - i] for i in range(len(data))])
+    data = np.ascontiguousarray(data[::-1])
     return data
 
 # main
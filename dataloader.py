@@ -1,44 +1,191 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.utils.rnn import pad_sequence
 import config as cfg
-
-# # If you don't set the data type to object when saving the data... 
-np_load_old = np.load
-np.load = lambda *a, **k: np_load_old(*a, allow_pickle=True, **k)
+from tools_for_dataset import load_pairs, is_sharded_dataset, normalization
+from generate_noisy_data import mix_at_snr
+from tools_for_augmentation import create_augmentation, AugmentedCollate
+from tools_for_distributed import is_distributed, get_rank, get_world_size
 
 
 def create_dataloader(mode, type=0, snr=0):
+    # the options only available with worker processes
+    worker_options = {}
+    if cfg.num_workers > 0:
+        worker_options = {
+            'prefetch_factor': cfg.prefetch_factor,
+            'persistent_workers': cfg.persistent_workers
+        }
+
     if mode == 'train':
+        dataset = Mixture_Dataset() if cfg.mixture else Wave_Dataset(mode, type, snr)
+
+        # augment the batches in the workers
+        collate_fn = pad_collate
+        augmentation = create_augmentation()
+        if augmentation is not None and not cfg.augment_on_device:
+            collate_fn = AugmentedCollate(augmentation, pad_collate)
+
+        if cfg.bucketing:
+            # batches of similar lengths (batch_size, shuffle and drop_last are given to the sampler)
+            batch_options = {
+                'batch_sampler': BucketBatchSampler(dataset.lengths(), cfg.micro_batch, shuffle=True, drop_last=True,
+                                                    bucket_batches=cfg.bucket_batches,
+                                                    num_replicas=get_world_size(), rank=get_rank())
+            }
+        elif is_distributed():
+            # each process gets its own part of the data
+            batch_options = {'batch_size': cfg.micro_batch, 'drop_last': True,
+                             'sampler': DistributedSampler(dataset, shuffle=True, drop_last=True)}
+        else:
+            batch_options = {'batch_size': cfg.micro_batch, 'shuffle': True, 'drop_last': True, 'sampler': None}
+
         return DataLoader(
-            dataset=Wave_Dataset(mode, type, snr),
-            batch_size=cfg.batch,
-            shuffle=True,
-            num_workers=0,
-            pin_memory=True,
-            drop_last=True,
-            sampler=None
+            dataset=dataset,
+            num_workers=cfg.num_workers,
+            pin_memory=cfg.pin_memory,
+            collate_fn=collate_fn,
+            **batch_options,
+            **worker_options
         )
     elif mode == 'valid':
+        dataset = Wave_Dataset(mode, type, snr)
+        # distributed: each process validates its own part
+        # (the DistributedSampler repeats a few samples to give the same number to every process)
+        sampler = DistributedSampler(dataset, shuffle=False) if is_distributed() else None
         return DataLoader(
-            dataset=Wave_Dataset(mode, type, snr),
-            batch_size=cfg.batch, shuffle=False, num_workers=0
+            dataset=dataset,
+            batch_size=cfg.micro_batch, shuffle=False, sampler=sampler, num_workers=cfg.num_workers,
+            pin_memory=cfg.pin_memory, collate_fn=pad_collate, **worker_options
         )
     elif mode == 'test':
         return DataLoader(
             dataset=Wave_Dataset(mode, type, snr),
-            batch_size=cfg.batch, shuffle=False, num_workers=0
+            batch_size=cfg.micro_batch, shuffle=False, num_workers=cfg.num_workers,
+            pin_memory=cfg.pin_memory, collate_fn=pad_collate, **worker_options
         )
 
+
+def set_epoch(dataloader, epoch):
+    """new shuffling (and mixtures) for every epoch, the same in every process"""
+    for obj in [dataloader.sampler, dataloader.batch_sampler, dataloader.dataset]:
+        if hasattr(obj, 'set_epoch'):
+            obj.set_epoch(epoch)
+
+
+def length_multiple():
+    """
+    the lengths of the batches are multiples of win_inc
+    (the ConvSTFT / ConviSTFT of DCCRN and CRN give the wav of a multiple of win_inc: the same length as the targets),
+    and of fs with the PMSQE loss (tools_for_loss.get_array_pmsqe_loss takes whole seconds)
+    """
+    if cfg.perceptual == 'PMSQE':
+        return int(np.lcm(cfg.win_inc, cfg.fs))
+    return cfg.win_inc
+
+
+def crop_length(crop_sec):
+    # crop_sec in samples, aligned to length_multiple()
+    if crop_sec is None:
+        return None
+    multiple = length_multiple()
+    return max(1, int(round(crop_sec * cfg.fs / multiple))) * multiple
+
+
+def pad_collate(batch):
+    """
+    Stack the batch, padding the samples with zeros to the longest one, rounded up to length_multiple().
+    Returns inputs [B, T], targets [B, T] and the valid lengths [B]
+    (see tools_for_loss.padding_mask to mask the padding out of the loss)
+    """
+    inputs = pad_sequence([pair[0] for pair in batch], batch_first=True)
+    targets = pad_sequence([pair[1] for pair in batch], batch_first=True)
+    lengths = torch.tensor([len(pair[0]) for pair in batch], dtype=torch.long)
+
+    padding = -inputs.size(-1) % length_multiple()
+    if padding > 0:
+        inputs = F.pad(inputs, [0, padding])
+        targets = F.pad(targets, [0, padding])
+    return inputs, targets, lengths
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler for the variable-length data.
+    The shuffled indices are split into pools of 'bucket_batches' batches,
+    and each pool is sorted by length before it is cut into batches,
+    so the samples of a batch have similar lengths and little padding.
+    The order of the batches is shuffled again.
+    The shuffling only depends on (seed, epoch) (see set_epoch),
+    and with num_replicas > 1 each process (rank) takes every num_replicas-th batch.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, bucket_batches=100,
+                 num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pool_size = batch_size * bucket_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def pools(self, generator):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+        else:
+            indices = np.arange(len(self.lengths))
+        for st in range(0, len(indices), self.pool_size):
+            yield indices[st:st + self.pool_size]
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        batches = []
+        for pool in self.pools(generator):
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            for st in range(0, len(pool), self.batch_size):
+                batch = pool[st:st + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        # the same number of batches for every process
+        batches = batches[:len(self) * self.num_replicas]
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        num = 0
+        for st in range(0, len(self.lengths), self.pool_size):
+            pool_len = min(self.pool_size, len(self.lengths) - st)
+            if self.drop_last:
+                num += pool_len // self.batch_size
+            else:
+                num += (pool_len + self.batch_size - 1) // self.batch_size
+        return num // self.num_replicas
+
+
 class Wave_Dataset(Dataset):
     def __init__(self, mode, type, snr):
+        self.crop_length = None
         # load data
         if mode == 'train':
             self.mode = 'train'
             print('<Training dataset>')
             print('Load the data...')
-            self.input_path = "./Dataset/train_shifting+minus+reverse+ori_data.npy"
-            self.input = np.load(self.input_path)
+            # sharded dataset directory (see tools_for_dataset.py), or the legacy '.npy' file
+            self.input_path = "./Dataset/train_shifting+minus+reverse+ori_data"
+            self.input = load_pairs(self.input_path)
+            # random fixed-length crop of each utterance (None: the whole utterance)
+            self.crop_length = crop_length(cfg.crop_sec)
             # self.input = [] # 여러 npy 불러오기
             # self.input.extend(np.load("./Dataset/train_shifting+ori_data.npy"))
             # self.input.extend(np.load("./Dataset/train_dataset_norm_tv31_snr51015_minus.npy"))
@@ -47,8 +194,8 @@ class Wave_Dataset(Dataset):
             self.mode = 'valid'
             print('<Validation dataset>')
             print('Load the data...')
-            self.input_path = "./Dataset/validation_dataset_norm_tv31_snr51015.npy"
-            self.input = np.load(self.input_path)
+            self.input_path = "./Dataset/validation_dataset_norm_tv31_snr51015"
+            self.input = load_pairs(self.input_path)
             # # if you want to use a part of the dataset
             # self.input = self.input[:500]
         elif mode == 'test':
@@ -57,18 +204,117 @@ class Wave_Dataset(Dataset):
             print('Load the data...')
             self.input_path = "/Dataset"
 
-            self.input = np.load(self.input_path)
-            self.input = self.input[type][snr]
+            if is_sharded_dataset('%s/%s/%s' % (self.input_path, type, snr)):
+                # one sharded dataset directory for each type and snr
+                self.input = load_pairs('%s/%s/%s' % (self.input_path, type, snr))
+            else:
+                self.input = load_pairs(self.input_path)
+                self.input = self.input[type][snr]
 
     def __len__(self):
         return len(self.input)
 
+    def lengths(self):
+        # [N] length of each pair (for the BucketBatchSampler)
+        if hasattr(self.input, 'lengths'):
+            lengths = np.asarray(self.input.lengths)
+        else:
+            lengths = np.array([len(pair[0]) for pair in self.input])
+        if self.crop_length is not None:
+            lengths = np.minimum(lengths, self.crop_length)
+        return lengths
+
+    def crop(self, idx):
+        # a random window of crop_length (shorter utterances are taken whole, and padded by pad_collate)
+        utt_len = int(self.lengths_of(idx))
+        if utt_len <= self.crop_length:
+            start, length = 0, utt_len
+        else:
+            # the start is also aligned to win_inc
+            start = int(torch.randint((utt_len - self.crop_length) // cfg.win_inc + 1, (1,))) * cfg.win_inc
+            length = self.crop_length
+        if hasattr(self.input, 'read'):
+            # sharded dataset: only the window is read from the memmap
+            return self.input.read(idx, start, length)
+        inputs, targets = self.input[idx]
+        return inputs[start:start + length], targets[start:start + length]
+
+    def lengths_of(self, idx):
+        if hasattr(self.input, 'lengths'):
+            return self.input.lengths[idx]
+        return len(self.input[idx][0])
+
     def __getitem__(self, idx):
-        inputs = self.input[idx][0]
-        targets = self.input[idx][1]
+        if self.crop_length is not None:
+            inputs, targets = self.crop(idx)
+        else:
+            inputs, targets = self.input[idx]
 
         # transform to torch from numpy
         inputs = torch.from_numpy(inputs)
         targets = torch.from_numpy(targets)
 
         return inputs, targets
+
+
+class Mixture_Dataset(Dataset):
+    """
+    Training dataset that mixes the noisy data on the fly.
+    A random clean segment, noise segment and SNR are picked for each item,
+    so no noisy file has to be generated and every epoch sees new mixtures.
+    """
+    def __init__(self):
+        print('<Training dataset (on-the-fly mixture)>')
+        print('Load the data...')
+        self.clean = load_pairs(cfg.mixture_clean_path)
+        self.noise = load_pairs(cfg.mixture_noise_path)
+        self.snr_set = np.asarray(cfg.mixture_snr, dtype=np.float64)
+        self.length = int(cfg.mixture_sec * cfg.fs)
+        if cfg.mixture_num is None:
+            self.num = len(self.clean) * len(self.snr_set)
+        else:
+            self.num = cfg.mixture_num
+        # shared memory, so that set_epoch() also reaches the (persistent) workers
+        self.epoch = torch.zeros(1, dtype=torch.long).share_memory_()
+
+    def set_epoch(self, epoch):
+        self.epoch.fill_(epoch)
+
+    def __len__(self):
+        return self.num
+
+    def lengths(self):
+        # every mixture has the same length
+        return np.full(self.num, self.length)
+
+    def segment(self, corpus, idx, rng, repeat):
+        utt_len = int(corpus.lengths[idx])
+        if utt_len > self.length:
+            start = int(rng.integers(0, utt_len - self.length + 1))
+            return corpus.read(idx, start, self.length)[0]
+        samples = corpus.read(idx)[0]
+        if repeat:  # noise: repeat it to the segment length
+            return np.resize(samples, self.length)
+        return np.pad(samples, [0, self.length - utt_len])
+
+    def __getitems__(self, indices):
+        # the whole batch is mixed at once
+        speech, noise, snr = [], [], []
+        for idx in indices:
+            rng = np.random.default_rng([cfg.mixture_seed, int(self.epoch), idx])
+            speech.append(self.segment(self.clean, idx % len(self.clean), rng, repeat=False))
+            noise.append(self.segment(self.noise, int(rng.integers(len(self.noise))), rng, repeat=True))
+            snr.append(rng.choice(self.snr_set))
+        speech = np.stack(speech)
+        noisy = mix_at_snr(speech, np.stack(noise), np.asarray(snr))
+
+        # normalization, same as the pre-generated data
+        noisy = normalization(noisy)
+        speech = normalization(speech)
+
+        inputs = torch.from_numpy(noisy.astype(np.float32))
+        targets = torch.from_numpy(speech.astype(np.float32))
+        return [(inputs[i], targets[i]) for i in range(len(indices))]
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
@@ -3,11 +3,17 @@ generate noisy data with various noise files
 """
 import os
 import sys
+import zlib
+import hashlib
 import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
 import scipy.io.wavfile as wav
 import librosa
 from pathlib import Path
 import soundfile
+from tools_for_dataset import ShardWriter, merge_datasets, normalization, \
+    MIXTURE_MANIFEST_NAME, write_mixture_manifest
 
 #######################################################################
 #                         data info setting                           #
@@ -43,45 +49,178 @@ def scan_directory(dir_name):
     return addr
 
 
+# Read a wav file as mono float32 samples at the sampling frequency fs.
+def read_wav(addr, fs):
+    wav, read_fs = soundfile.read(addr, dtype='float32')
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    if read_fs != fs:
+        wav = librosa.resample(wav, orig_sr=read_fs, target_sr=fs)
+    return wav.astype(np.float32)
+
+
+class NoiseBank(object):
+    """
+    Cache of the decoded noise files.
+    Each noise is read, down-mixed and resampled only once, and saved as a float32 .npy file
+    in 'cache_dir' keyed by (path, fs). The files are memory-mapped when used, and the least recently
+    used ones are unmapped when more than 'max_bytes' are mapped, so the noise corpus can be larger than RAM.
+    The cache directory is kept, so the next run does not decode the noise files at all.
+    """
+    def __init__(self, cache_dir, max_bytes=2 ** 31):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.mapped = OrderedDict()  # (path, fs) -> memory-mapped samples
+        self.mapped_bytes = 0
+        if os.path.isdir(self.cache_dir) is False:
+            os.makedirs(self.cache_dir)
+
+    def cache_path(self, addr, fs):
+        # the modification time is in the key, so a changed noise file is decoded again
+        addr = os.path.abspath(str(addr))
+        key = '%s:%d:%d' % (addr, fs, os.path.getmtime(addr))
+        return self.cache_dir / (hashlib.md5(key.encode()).hexdigest() + '.npy')
+
+    def get(self, addr, fs):
+        key = (str(addr), fs)
+        if key in self.mapped:
+            self.mapped.move_to_end(key)
+            return self.mapped[key]
+
+        path = self.cache_path(addr, fs)
+        if not os.path.exists(path):
+            tmp_path = str(path) + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'wb') as f:
+                np.save(f, read_wav(addr, fs))
+            os.replace(tmp_path, path)
+
+        wav = np.load(path, mmap_mode='r')
+        self.mapped[key] = wav
+        self.mapped_bytes += wav.nbytes
+        while self.mapped_bytes > self.max_bytes and len(self.mapped) > 1:
+            _, evicted = self.mapped.popitem(last=False)
+            self.mapped_bytes -= evicted.nbytes
+        return wav
+
+
 # Generate noisy data given speech, noise, and target SNR.
 def generate_noisy_wav(wav_speech, wav_noise, snr): # clean / noise / snr => clean과 noise를 결합하여 snr의 noisy 데이터를 만들어냄.
-    # Obtain the length of speech and noise components.
-    len_speech = len(wav_speech) # clean 파일의 길이 48000
-    len_noise = len(wav_noise) # noise 파일의 길이 160000
-    # clean과 noise의 길이를 같게 해줘야함
-
     # Select noise segment randomly to have same length with speech signal.
     # clean 파일과 똑같은 길이를 가지도록 랜덤으로 noise 파일의 구간을 지정함.
-    st = np.random.randint(0, len_noise - len_speech) # st : 73637
+    wav_noise, _ = select_noise_segment(wav_noise, len(wav_speech))
+
+    noisy_wav = mix_at_snr(wav_speech, wav_noise, snr) * 32768
+    noisy_wav = noisy_wav.astype(np.int16)
+
+    return noisy_wav
+
+
+# Select a noise segment that has the same length with the speech. (rng: np.random.Generator, or the global state)
+def select_noise_segment(wav_noise, len_speech, rng=None):
+    len_noise = len(wav_noise) # noise 파일의 길이 160000
+    if len_noise <= len_speech:
+        # the noise is too short: repeat it
+        return np.resize(wav_noise, len_speech), 0
+
+    if rng is None:
+        st = np.random.randint(0, len_noise - len_speech) # st : 73637
+    else:
+        st = int(rng.integers(0, len_noise - len_speech))
     ed = st + len_speech # ed : 121637
-    wav_noise = wav_noise[st:ed] # 결론적으로 noise 파일의 길이는 clean과 동일해짐
+    return wav_noise[st:ed], st # 결론적으로 noise 파일의 길이는 clean과 동일해짐
 
+
+# Mix speech and noise segments of the same length at the target SNR.
+# It works on a batch too: wav_speech, wav_noise [..., T] / snr: scalar or [...]
+def mix_at_snr(wav_speech, wav_noise, snr):
     # Compute the power of speech and noise after removing DC bias.
-    dc_speech = np.mean(wav_speech)
-    dc_noise = np.mean(wav_noise)
-    pow_speech = np.mean(np.power(wav_speech - dc_speech, 2.0))
-    pow_noise = np.mean(np.power(wav_noise - dc_noise, 2.0))
+    dc_speech = np.mean(wav_speech, axis=-1, keepdims=True)
+    dc_noise = np.mean(wav_noise, axis=-1, keepdims=True)
+    pow_speech = np.mean(np.power(wav_speech - dc_speech, 2.0), axis=-1, keepdims=True)
+    pow_noise = np.mean(np.power(wav_noise - dc_noise, 2.0), axis=-1, keepdims=True)
 
     # Compute the scale factor of noise component depending on the target SNR.
-    alpha = np.sqrt(10.0 ** (float(-snr) / 10.0) * pow_speech / (pow_noise + 1e-6))
-    noisy_wav = (wav_speech + alpha * wav_noise) * 32768
-    noisy_wav = noisy_wav.astype(np.int16)
+    snr = np.expand_dims(np.asarray(snr, dtype=np.float64), -1)
+    alpha = np.sqrt(10.0 ** (-snr / 10.0) * pow_speech / (pow_noise + 1e-6))
+    return wav_speech + alpha * wav_noise
 
-    return noisy_wav
+
+#######################################################################
+#                     parallel generation (main)                      #
+#######################################################################
+# Each job (one noisy file) has its own random generator made from the seed, the clean file name and the snr,
+# so the outputs do not depend on the number of workers, on the order of the jobs,
+# or on running the SNRs together or separately.
+def generate_part(part_idx, jobs, list_noise_files, snr_set, fs, seed, noisy_dir, noise_cache_dir, dataset_dir):
+    """Generate the noisy data of the jobs [(job_idx, addr_speech, snr or None)] in one worker.
+    If the snr of a job is None, it is selected randomly in snr_set.
+    It writes the wav files in noisy_dir, or into its own part of the sharded dataset if dataset_dir is given.
+    Returns the manifest rows of the jobs [(job_idx, row)].
+    """
+    noise_bank = NoiseBank(noise_cache_dir)
+    writer = None
+    if dataset_dir is not None:
+        writer = ShardWriter(Path(dataset_dir) / ('part_%03d' % part_idx))
+
+    rows = []
+    for job_idx, addr_speech, snr_in_db in jobs:
+        job_name = '%s:%s' % (Path(addr_speech).name, 'random' if snr_in_db is None else snr_in_db)
+        rng = np.random.default_rng([seed, zlib.crc32(job_name.encode())])
+
+        # Load speech waveform and its sampling frequency.
+        wav_speech, read_fs = soundfile.read(addr_speech) # wav_speech는 data / read_fs는 sample rate(여기서는 16000)를 의미함.
+        if read_fs != fs:
+            wav_speech = librosa.resample(wav_speech, orig_sr=read_fs, target_sr=fs) # fs(16000)으로 resample
+
+        # Select a noise component randomly, and read it.
+        addr_noise = list_noise_files[int(rng.integers(0, len(list_noise_files)))] # noise 파일 중 랜덤으로 하나를 뽑음
+        wav_noise = noise_bank.get(addr_noise, fs) # noise 파일의 data (mono, fs)를 cache에서 얻음
+
+        # Select an SNR randomly. (validation)
+        if snr_in_db is None:
+            snr_in_db = int(snr_set[int(rng.integers(0, len(snr_set)))])
+        wav_noise, offset = select_noise_segment(wav_noise, len(wav_speech), rng)
+
+        # Generate noisy speech by mixing speech and noise components.
+        wav_noisy = (mix_at_snr(wav_speech, wav_noise, snr_in_db) * 32768).astype(np.int16)
+
+        # noisy 데이터의 이름 = clean 이름 + noise 이름 + snr
+        noisy_name = Path(addr_speech).name[:-4] + '_' + Path(addr_noise).name[:-4] + '_' + str(snr_in_db) + '.wav'
+        addr_noisy = Path(noisy_dir) / noisy_name
+        if writer is None:
+            wav.write(addr_noisy, fs, wav_noisy) # addr_noisy 경로에 wav_noisy 파일을 fs로 생성.
+        else:
+            # same as reading the wav files with wav_to_shard.py
+            writer.add(str(addr_noisy), normalization(wav_noisy.astype(np.float32) / 32768),
+                       normalization(np.asarray(wav_speech, dtype=np.float32)))
+
+        rows.append((job_idx, {'noisy': str(addr_noisy), 'clean': str(addr_speech), 'noise': str(addr_noise),
+                               'snr': snr_in_db, 'offset': offset, 'length': len(wav_speech)}))
+
+    if writer is not None:
+        writer.close()
+    print('part %d: %d files done' % (part_idx, len(rows)))
+    return rows
 
 
 def main():
     argvs = sys.argv[1:] # sys.argv는 실행 시의 parameter 값을 저장함. 단, index 0에는 실행하는 py코드명이 담김. index 1부터 parameter가 담기는 것임.
-    if len(argvs) != 3: # parameter가 3개가 아닌 경우 에러. mode / snr / fs. 총 3개를 입력해줘야함.
+    if len(argvs) < 3 or len(argvs) > 6: # mode / snr / fs는 반드시 입력해줘야함.
         print('Error: Invalid input arguments')
-        print('\t Usage: python generate_noisy_data.py [mode] [snr] [fs]')
+        print('\t Usage: python generate_noisy_data.py [mode] [snr] [fs] [workers] [seed] [dataset_dir]')
         print("\t\t [mode]: 'train', 'validation'")
         print("\t\t [snr]: '0', '0, 5', ...'") # snr은 신호 대 잡음비로. 0이면 신호와 잡음 비율이 같다는 의미. 즉, 높을수록 잡음이 적어 좋은 것임.
         print("\t\t [fs]: '16000', ...")
+        print("\t\t [workers]: number of processes (default: 1)")
+        print("\t\t [seed]: master seed of the random generators (default: 0)")
+        print("\t\t [dataset_dir]: write the sharded dataset instead of the wav files (optional)")
         exit()
     mode = argvs[0] # mode
-    snr_set = argvs[1].split(',') # snr / , 기준으로 잘라서 snr_set에 저장.
+    snr_set = [int(snr) for snr in argvs[1].split(',')] # snr / , 기준으로 잘라서 snr_set에 저장.
     fs = int(argvs[2]) # fs
+    num_workers = int(argvs[3]) if len(argvs) > 3 else 1
+    seed = int(argvs[4]) if len(argvs) > 4 else 0
+    dataset_dir = argvs[5] if len(argvs) > 5 else None
 
     # Set speech and noise directory.
     speech_dir = Path("./Dataset")
@@ -91,88 +230,54 @@ def main():
     speech_mode_noisy_dir = speech_dir / mode / 'noisy_aug' # noisy 파일 저장 경로
     list_speech_files = scan_directory(speech_mode_clean_dir)
 
-    # Make directories of the mode and noisy data.
-    if os.path.isdir(speech_mode_clean_dir) is False:
-        os.system('mkdir ' + str(speech_mode_clean_dir)) # os.system을 통해 CMD 명령어를 사용할 수 있음.
-
-    if os.path.isdir(speech_mode_noisy_dir) is False:
-        os.system('mkdir ' + str(speech_mode_noisy_dir))
+    # Make directories of the mode and noisy data. (no wav file is written with dataset_dir)
+    if dataset_dir is None and os.path.isdir(speech_mode_noisy_dir) is False:
+        os.makedirs(speech_mode_noisy_dir)
 
-    # Define a log file name.
-    log_file_name = Path("./log_generate_data_" + mode + ".txt")
-    f = open(log_file_name, 'w')
+    # Make a noise file list
+    # validation도 train의 noise를 다시 사용함. 단, clean은 train때 사용하지 않은 것으로만 사용해야 함.!
+    noise_subset_dir = speech_dir / 'train' / 'noise'
+    list_noise_files = scan_directory(noise_subset_dir)
 
+    # Make the jobs (job index, clean file, snr)
     if mode == 'train':
-        # Make a noise file list
-        noise_subset_dir = speech_dir / 'train' / 'noise'
-        list_noise_files = scan_directory(noise_subset_dir) # train noise 디렉토리의 파일들을 리스트에 담음
-        for snr_in_db in snr_set:
-            for addr_speech in list_speech_files: # clean 디렉토리의 파일들을 불러옴
-                # Load speech waveform and its sampling frequency.
-                wav_speech, read_fs = soundfile.read(addr_speech) # wav_speech는 data / read_fs는 sample rate(여기서는 16000)를 의미함.
-                if read_fs != fs:
-                    wav_speech = librosa.resample(wav_speech, read_fs, fs) # clean파일의 sampe rate이 fs와 같지 않다면 fs(16000)으로 resample
-
-                # Select a noise component randomly, and read it.
-                nidx = np.random.randint(0, len(list_noise_files)) # noise 파일 중 랜덤으로 하나를 뽑음
-                addr_noise = list_noise_files[nidx]  # 랜덤으로 뽑은 noise파일 주소를 addr_noise에 담음
-                wav_noise, read_fs = soundfile.read(addr_noise) # 랜덤으로 뽑은 noise 파일의 data와 sample rate을 얻음
-                if wav_noise.ndim > 1:
-                    wav_noise = wav_noise.mean(axis=1)
-                if read_fs != fs:
-                    wav_noise = librosa.resample(wav_noise, read_fs, fs)
-
-                # Generate noisy speech by mixing speech and noise components.
-                # clean / noise / snr을 파라메터로 넣어 noisy 데이터를 얻음
-                wav_noisy = generate_noisy_wav(wav_speech, wav_noise, int(snr_in_db))
-                # noisy 데이터의 이름 = clean 이름 + noise 이름 + snr
-                noisy_name = Path(addr_speech).name[:-4] +'_' + Path(addr_noise).name[:-4] + '_' + str(
-                                  int(snr_in_db)) + '.wav'
-                addr_noisy = speech_mode_noisy_dir / noisy_name # 생성한 noisy 파일은 mode/noisy  디렉토리에 담고 그 경로.
-                wav.write(addr_noisy, fs, wav_noisy) # addr_noisy 경로에 wav_noisy 파일을 fs로 생성.
-
-                # Display progress.
-                print('%s > %s' % (addr_speech, addr_noisy))
-                f.write('%s\t%s\t%s\t%d dB\n' % (addr_noisy, addr_speech, addr_noise, int(snr_in_db)))
-
+        # every snr for every clean file
+        jobs = [(snr_idx * len(list_speech_files) + idx, addr_speech, snr_in_db)
+                for snr_idx, snr_in_db in enumerate(snr_set)
+                for idx, addr_speech in enumerate(list_speech_files)]
     elif mode == 'validation':
-        # Make a noise file list for validation.
-        noise_subset_dir = speech_dir / 'train' / 'noise' # noise 데이터는 train의 noise를 다시 사용함. 단, clean은 train때 사용하지 않은 것으로만 사용해야 함.!
-        list_noise_files = scan_directory(noise_subset_dir)
-
-        for addr_speech in list_speech_files: # clean 데이터는 처음에 인자로 준 mode에 따라 변경됨.
-            # Load speech waveform and its sampling frequency.
-            wav_speech, read_fs = soundfile.read(addr_speech)
-            if read_fs != fs:
-                wav_speech = librosa.resample(wav_speech, read_fs, fs)
-
-            # Select a noise component randomly, and read it.
-            nidx = np.random.randint(0, len(list_noise_files))
-            addr_noise = list_noise_files[nidx]
-            wav_noise, read_fs = soundfile.read(addr_noise)
-            if wav_noise.ndim > 1:
-                wav_noise = wav_noise.mean(axis=1)
-            if read_fs != fs:
-                wav_noise = librosa.resample(wav_noise, read_fs, fs)
-
-            # Select an SNR randomly.
-            # input한 SNR 중 랜덤으로 하나를 선택하는데, 그 이유는.. ?
-            ridx_snr = np.random.randint(0, len(snr_set))
-            snr_in_db = int(snr_set[ridx_snr])
-
-            # Generate noisy speech by mixing speech and noise components.
-            wav_noisy = generate_noisy_wav(wav_speech, wav_noise, snr_in_db)
-
-            # Write the generated noisy speech into a file.
-            noisy_name = Path(addr_speech).name[:-4] + '_' + Path(addr_noise).name[:-4] + '_' + str(
-                              snr_in_db) + '.wav'
-            addr_noisy = speech_mode_noisy_dir / noisy_name
-            wav.write(addr_noisy, fs, wav_noisy)
-
-            # Display progress.
-            print('%s > %s' % (addr_speech, addr_noisy))
-            f.write('%s\t%s\t%s\t%d dB\n' % (addr_noisy, addr_speech, addr_noise, snr_in_db))
-    f.close()
+        # one random snr for each clean file
+        jobs = [(idx, addr_speech, None) for idx, addr_speech in enumerate(list_speech_files)]
+    else:
+        print("Error: Invalid mode '%s'" % mode)
+        exit()
+
+    # Split the jobs for the workers (a few parts per worker to balance the load)
+    num_parts = min(len(jobs), num_workers * 4) if num_workers > 1 else 1
+    parts = [(part_idx, jobs[part_idx::num_parts], list_noise_files, snr_set, fs, seed,
+              speech_mode_noisy_dir, speech_dir / 'noise_cache', dataset_dir)
+             for part_idx in range(num_parts)]
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            rows = pool.starmap(generate_part, parts)
+    else:
+        rows = [generate_part(*part) for part in parts]
+    rows = [row for _, row in sorted((row for part_rows in rows for row in part_rows), key=lambda x: x[0])]
+
+    # Collect the parts of the sharded dataset into one dataset
+    if dataset_dir is not None:
+        merge_datasets(dataset_dir, [Path(dataset_dir) / ('part_%03d' % part_idx) for part_idx in range(num_parts)])
+
+    # Write the manifest of the generated data (the pairs are read from it, see wav_to_shard.py)
+    # with dataset_dir, it is written next to the sharded dataset: the noisy wav files do not exist,
+    # and wav_to_shard.py would read them from the manifest in noisy_aug
+    if dataset_dir is None:
+        manifest_name = speech_mode_noisy_dir / MIXTURE_MANIFEST_NAME
+    else:
+        manifest_name = Path(dataset_dir) / MIXTURE_MANIFEST_NAME
+    write_mixture_manifest(manifest_name, rows)
+    print('%d noisy files are generated (%s)' % (len(rows), manifest_name))
+
 
 if __name__ == '__main__':
     main()
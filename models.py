@@ -1,18 +1,25 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from typing import Optional, Tuple, Final
 from tools_for_model import ConvSTFT, ConviSTFT, \
     ComplexConv2d, ComplexConvTranspose2d, NavieComplexLSTM, complex_cat, ComplexBatchNorm, \
     RealConv2d, RealConvTranspose2d, \
     BaseModel, SequenceModel
 import config as cfg
-from tools_for_loss import sdr, si_sdr, si_snr, get_array_lms_loss, get_array_pmsqe_loss
+from tools_for_loss import sdr, si_sdr, si_snr, mse, get_array_lms_loss, get_array_pmsqe_loss
 
 
 #######################################################################
 #                         complex network                             #
 #######################################################################
 class DCCRN(nn.Module):
+    # fixed in __init__ (constants for torch.jit.script)
+    direct_mapping: Final[bool]
+    complex_lstm: Final[bool]
+    skip_type: Final[bool]
+    causal: Final[bool]
 
     def __init__(
             self,
@@ -24,11 +31,19 @@ class DCCRN(nn.Module):
             win_type=cfg.window,
             masking_mode=cfg.masking_mode,
             use_cbn=False,
-            kernel_size=5
+            kernel_size=5,
+            lstm=cfg.lstm,
+            skip_type=cfg.skip_type,
+            causal=cfg.dccrn_causal
     ):
         '''
             rnn_layers: the number of lstm layers in the crn,
             rnn_units: for clstm, rnn_units = real+imag
+            lstm: 'complex' or 'real'
+            skip_type: use the skip connection
+            causal: each decoder layer drops its last output frame instead of the first,
+                    so no output frame depends on the future frames (the same parameters, see DCCRNStreamer)
+            (the setting is fixed here, forward only depends on the inputs: torch.compile / torch.jit.script)
         '''
 
         super(DCCRN, self).__init__()
@@ -50,6 +65,10 @@ class DCCRN(nn.Module):
         kernel_num = cfg.dccrn_kernel_num
         self.kernel_num = [2] + kernel_num
         self.masking_mode = masking_mode
+        self.direct_mapping = masking_mode == 'Direct(None make)'
+        self.complex_lstm = lstm == 'complex'
+        self.skip_type = skip_type
+        self.causal = causal
 
         # bidirectional=True
         bidirectional = False
@@ -80,19 +99,22 @@ class DCCRN(nn.Module):
             )
         hidden_dim = self.fft_len // (2 ** (len(self.kernel_num)))
 
-        if cfg.lstm == 'complex':
-            rnns = []
+        if self.complex_lstm:
+            # ModuleList (not Sequential): each layer takes (real, imag)
+            self.enhance = nn.ModuleList()
             for idx in range(rnn_layers):
-                rnns.append(
+                self.enhance.append(
                     NavieComplexLSTM(
                         input_size=hidden_dim * self.kernel_num[-1] if idx == 0 else self.rnn_units,
                         hidden_size=self.rnn_units,
                         bidirectional=bidirectional,
                         batch_first=False,
                         projection_dim=hidden_dim * self.kernel_num[-1] if idx == rnn_layers - 1 else None,
+                        # measured: batched is slower on the first layer (input: the encoder output), faster after
+                        batched=idx > 0,
                     )
                 )
-                self.enhance = nn.Sequential(*rnns)
+            self.tranform = nn.Identity()
         else:
             self.enhance = nn.LSTM(
                 input_size=hidden_dim * self.kernel_num[-1],
@@ -104,7 +126,7 @@ class DCCRN(nn.Module):
             )
             self.tranform = nn.Linear(self.rnn_units * fac, hidden_dim * self.kernel_num[-1])
 
-        if cfg.skip_type:
+        if self.skip_type:
             for idx in range(len(self.kernel_num) - 1, 0, -1):
                 if idx != 1:
                     self.decoder.append(
@@ -173,13 +195,16 @@ class DCCRN(nn.Module):
         if isinstance(self.enhance, nn.LSTM):
             self.enhance.flatten_parameters()
 
-    def forward(self, inputs, targets=0):
+    def forward(self, inputs) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        inputs: [B, T] noisy wav
+        returns: real, imag [B, F, T'] of the enhanced spec (masked, or mapped in 'Direct(None make)'),
+                 and the enhanced wav [B, T]
+        """
         specs = self.stft(inputs)
         real = specs[:, :self.fft_len // 2 + 1]
         imag = specs[:, self.fft_len // 2 + 1:]
-        spec_mags = torch.sqrt(real ** 2 + imag ** 2 + 1e-8)
 
-        spec_phase = torch.atan2(imag, real)
         cspecs = torch.stack([real, imag], 1)
         cspecs = cspecs[:, :, 1:]
         '''
@@ -192,20 +217,21 @@ class DCCRN(nn.Module):
         out = cspecs
         encoder_out = []
 
-        for idx, layer in enumerate(self.encoder):
+        for layer in self.encoder:
             out = layer(out)
             #    print('encoder', out.size())
             encoder_out.append(out)
 
         batch_size, channels, dims, lengths = out.size()
         out = out.permute(3, 0, 1, 2)
-        if cfg.lstm == 'complex':
+        if self.complex_lstm:
             r_rnn_in = out[:, :, :channels // 2]
             i_rnn_in = out[:, :, channels // 2:]
             r_rnn_in = torch.reshape(r_rnn_in, [lengths, batch_size, channels // 2 * dims])
             i_rnn_in = torch.reshape(i_rnn_in, [lengths, batch_size, channels // 2 * dims])
 
-            r_rnn_in, i_rnn_in = self.enhance([r_rnn_in, i_rnn_in])
+            for rnn in self.enhance:
+                r_rnn_in, i_rnn_in = rnn(r_rnn_in, i_rnn_in)
 
             r_rnn_in = torch.reshape(r_rnn_in, [lengths, batch_size, channels // 2, dims])
             i_rnn_in = torch.reshape(i_rnn_in, [lengths, batch_size, channels // 2, dims])
@@ -219,35 +245,37 @@ class DCCRN(nn.Module):
 
         out = out.permute(1, 2, 3, 0)
 
-        if cfg.skip_type:  # use skip connection
-            for idx in range(len(self.decoder)):
+        if self.skip_type:  # use skip connection
+            for idx, layer in enumerate(self.decoder):
                 out = complex_cat([out, encoder_out[-1 - idx]], 1)
-                out = self.decoder[idx](out)
-                out = out[..., 1:]  #
+                out = layer(out)
+                out = out[..., :-1] if self.causal else out[..., 1:]
         else:
-            for idx in range(len(self.decoder)):
-                out = self.decoder[idx](out)
-                out = out[..., 1:]
+            for layer in self.decoder:
+                out = layer(out)
+                out = out[..., :-1] if self.causal else out[..., 1:]
 
-        if self.masking_mode == 'Direct(None make)':
-            # for loss calculation
-            target_specs = self.stft(targets)
-            target_real = target_specs[:, :self.fft_len // 2 + 1]
-            target_imag = target_specs[:, self.fft_len // 2 + 1:]
+        out_real, out_imag = self.apply_mask(out, real, imag)
+        out_spec = torch.cat([out_real, out_imag], 1)
 
+        out_wav = self.istft(out_spec)
+        out_wav = torch.squeeze(out_wav, 1)
+        out_wav = torch.clamp_(out_wav, -1, 1)
+
+        return out_real, out_imag, out_wav
+
+    def apply_mask(self, out, real, imag) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        out: [B, 2, F-1, T] output of the decoder
+        real, imag: [B, F, T] noisy spec
+        returns: real, imag [B, F, T] of the enhanced spec
+        """
+        if self.direct_mapping:
             # spectral mapping
             out_real = out[:, 0]
             out_imag = out[:, 1]
             out_real = F.pad(out_real, [0, 0, 1, 0])
             out_imag = F.pad(out_imag, [0, 0, 1, 0])
-
-            out_spec = torch.cat([out_real, out_imag], 1)
-
-            out_wav = self.istft(out_spec)
-            out_wav = torch.squeeze(out_wav, 1)
-            out_wav = torch.clamp_(out_wav, -1, 1)
-
-            return out_real, target_real, out_imag, target_imag, out_wav
         else:
             #    print('decoder', out.size())
             mask_real = out[:, 0]
@@ -256,6 +284,8 @@ class DCCRN(nn.Module):
             mask_imag = F.pad(mask_imag, [0, 0, 1, 0])
 
             if self.masking_mode == 'E':
+                spec_mags = torch.sqrt(real ** 2 + imag ** 2 + 1e-8)
+                spec_phase = torch.atan2(imag, real)
                 mask_mags = (mask_real ** 2 + mask_imag ** 2) ** 0.5
                 real_phase = mask_real / (mask_mags + 1e-8)
                 imag_phase = mask_imag / (mask_mags + 1e-8)
@@ -272,16 +302,16 @@ class DCCRN(nn.Module):
                 out_imag = est_mags * torch.sin(est_phase)
             elif self.masking_mode == 'C':
                 out_real, out_imag = real * mask_real - imag * mask_imag, real * mask_imag + imag * mask_real
-            elif self.masking_mode == 'R':
+            else:  # 'R'
                 out_real, out_imag = real * mask_real, imag * mask_imag
+        return out_real, out_imag
 
-            out_spec = torch.cat([out_real, out_imag], 1)
-
-            out_wav = self.istft(out_spec)
-            out_wav = torch.squeeze(out_wav, 1)
-            out_wav = torch.clamp_(out_wav, -1, 1)
-
-            return out_real, out_imag, out_wav
+    def target_spec(self, targets) -> Tuple[torch.Tensor, torch.Tensor]:
+        """real, imag [B, F, T'] of the clean spec (for the loss of 'Direct(None make)')"""
+        target_specs = self.stft(targets)
+        target_real = target_specs[:, :self.fft_len // 2 + 1]
+        target_imag = target_specs[:, self.fft_len // 2 + 1:]
+        return target_real, target_imag
 
     def get_params(self, weight_decay=0.0):
         # add L2 penalty
@@ -300,7 +330,7 @@ class DCCRN(nn.Module):
         }]
         return params
 
-    def loss(self, estimated, target, real_spec=0, img_spec=0, perceptual=False):
+    def loss(self, estimated, target, real_spec=0, img_spec=0, perceptual=False, mask=None):
         if perceptual:
             if cfg.perceptual == 'LMS':
                 clean_specs = self.stft(target)
@@ -314,19 +344,148 @@ class DCCRN(nn.Module):
                 return get_array_pmsqe_loss(target, estimated)
         else:
             if cfg.loss == 'MSE':
-                return F.mse_loss(estimated, target, reduction='mean')
+                return mse(estimated, target, mask)
             elif cfg.loss == 'SDR':
-                return -sdr(target, estimated)
+                return -sdr(target, estimated, mask=mask)
             elif cfg.loss == 'SI-SNR':
-                return -(si_snr(estimated, target))
+                return -(si_snr(estimated, target, mask=mask))
             elif cfg.loss == 'SI-SDR':
-                return -(si_sdr(target, estimated))
+                return -(si_sdr(target, estimated, mask=mask))
+
+
+class DCCRNStreamer(object):
+    """
+    Streaming inference of a causal DCCRN (causal=True), frame by frame with the states of the layers
+    The output is the same as model(wav)[-1] of the whole wav, delayed by win_len - win_inc samples (overlap-add).
+
+        streamer = DCCRNStreamer(model)
+        for chunk in chunks:  # [B, any length]
+            out = streamer.process_chunk(chunk)
+        out = streamer.flush()  # the rest of the output
+    """
+
+    def __init__(self, model):
+        assert model.causal, 'the streaming inference needs DCCRN(causal=True)'
+        self.model = model.eval()
+        self.win_len = model.win_len
+        self.win_inc = model.win_inc
+        self.reset()
+
+    def reset(self):
+        self.inputs = None  # not processed input samples (starts with the padding of the stft)
+        self.encoder_states = [None] * len(self.model.encoder)  # past input frames of each layer
+        self.decoder_states = [None] * len(self.model.decoder)
+        self.rnn_states = None
+        self.numerator = None  # overlap-add of the frames
+        self.denominator = None  # overlap-add of window ** 2
+        self.skip = self.win_len - self.win_inc  # the padding of the stft is not a part of the output
+
+    @staticmethod
+    def step_conv(conv, inputs, state, num_past):
+        # the past frames [B, C, D, num_past] are kept in the state
+        if state is None:
+            state = inputs.new_zeros(inputs.shape[:-1] + (num_past,))
+        inputs = torch.cat([state, inputs], -1)
+        return inputs, inputs[..., inputs.size(-1) - num_past:]
+
+    def process_frame(self, frame):
+        """[B, win_len] -> [B, win_len] enhanced frame before the overlap-add"""
+        model = self.model
+        dim = model.fft_len // 2 + 1
+        specs = model.stft.spectrum(frame).unsqueeze(-1)  # [B, N+2, 1]
+        real = specs[:, :dim]
+        imag = specs[:, dim:]
+
+        out = torch.stack([real, imag], 1)[:, :, 1:]
+        encoder_out = []
+        for idx, layer in enumerate(model.encoder):
+            out, self.encoder_states[idx] = self.step_conv(layer[0], out, self.encoder_states[idx],
+                                                           layer[0].padding[1])
+            out = layer[1:](layer[0].convolve(out))
+            encoder_out.append(out)
+
+        batch_size, channels, dims, lengths = out.size()
+        out = out.permute(3, 0, 1, 2)
+        if model.complex_lstm:
+            r_rnn_in = torch.reshape(out[:, :, :channels // 2], [lengths, batch_size, channels // 2 * dims])
+            i_rnn_in = torch.reshape(out[:, :, channels // 2:], [lengths, batch_size, channels // 2 * dims])
+            if self.rnn_states is None:
+                self.rnn_states = [None] * len(model.enhance)
+            for idx, rnn in enumerate(model.enhance):
+                r_rnn_in, i_rnn_in, self.rnn_states[idx] = rnn.step(r_rnn_in, i_rnn_in, self.rnn_states[idx])
+            r_rnn_in = torch.reshape(r_rnn_in, [lengths, batch_size, channels // 2, dims])
+            i_rnn_in = torch.reshape(i_rnn_in, [lengths, batch_size, channels // 2, dims])
+            out = torch.cat([r_rnn_in, i_rnn_in], 2)
+        else:
+            out = torch.reshape(out, [lengths, batch_size, channels * dims])
+            out, self.rnn_states = model.enhance(out, self.rnn_states)
+            out = model.tranform(out)
+            out = torch.reshape(out, [lengths, batch_size, channels, dims])
+        out = out.permute(1, 2, 3, 0)
+
+        for idx, layer in enumerate(model.decoder):
+            if model.skip_type:
+                out = complex_cat([out, encoder_out[-1 - idx]], 1)
+            num_past = layer[0].kernel_size[1] - 1
+            out, self.decoder_states[idx] = self.step_conv(layer[0], out, self.decoder_states[idx], num_past)
+            # the output frame of the current input frame (the same as out[..., :-1] of the causal DCCRN)
+            out = layer(out)[..., num_past:num_past + 1]
+
+        out_real, out_imag = model.apply_mask(out, real, imag)
+        return model.istft.frame(torch.cat([out_real, out_imag], 1)[..., 0])
+
+    def overlap_add(self, frame):
+        # add the frame, and returns the first win_inc samples (no later frame is added to them)
+        if self.numerator is None:
+            self.numerator = frame.new_zeros(frame.size(0), self.win_len)
+            self.denominator = frame.new_zeros(self.win_len)
+        self.numerator += frame
+        self.denominator += self.model.istft.window.view(-1) ** 2
+
+        outputs = self.numerator[:, :self.win_inc] / (self.denominator[:self.win_inc] + 1e-8)
+        self.numerator = F.pad(self.numerator[:, self.win_inc:], [0, self.win_inc])
+        self.denominator = F.pad(self.denominator[self.win_inc:], [0, self.win_inc])
+        return outputs
+
+    def process_chunk(self, samples):
+        """
+        samples: [B, L] the next samples of the noisy wav (any L)
+        returns: [B, L'] the next samples of the enhanced wav (L' can be 0)
+        """
+        with torch.no_grad():
+            samples = samples.float()
+            if self.inputs is None:
+                self.inputs = samples.new_zeros(samples.size(0), self.win_len - self.win_inc)
+            self.inputs = torch.cat([self.inputs, samples], -1)
+
+            outputs = [samples.new_zeros(samples.size(0), 0)]
+            while self.inputs.size(-1) >= self.win_len:
+                frame = self.process_frame(self.inputs[:, :self.win_len])
+                outputs.append(self.overlap_add(frame))
+                self.inputs = self.inputs[:, self.win_inc:]
+            outputs = torch.cat(outputs, -1)
+
+            skip = min(self.skip, outputs.size(-1))
+            self.skip -= skip
+            return torch.clamp_(outputs[:, skip:], -1, 1)
+
+    def flush(self):
+        """the rest of the output (with the padding at the end, like the stft), then reset for the next wav"""
+        if self.inputs is None:
+            return None
+        outputs = self.process_chunk(self.inputs.new_zeros(self.inputs.size(0), self.win_len - self.win_inc))
+        self.reset()
+        return outputs
 
 
 #######################################################################
 #                            real network                             #
 #######################################################################
 class CRN(nn.Module):
+    # fixed in __init__ (constants for torch.jit.script)
+    direct_mapping: Final[bool]
+    skip_type: Final[bool]
+
     def __init__(
             self,
             rnn_layers=cfg.rnn_layers,
@@ -337,10 +496,12 @@ class CRN(nn.Module):
             fft_len=cfg.fft_len,
             win_type=cfg.window,
             masking_mode=cfg.masking_mode,
-            kernel_size=5
+            kernel_size=5,
+            skip_type=cfg.skip_type
     ):
         '''
             rnn_layers: the number of lstm layers in the crn
+            skip_type: use the skip connection
         '''
 
         super(CRN, self).__init__()
@@ -363,6 +524,8 @@ class CRN(nn.Module):
         kernel_num = cfg.dccrn_kernel_num
         self.kernel_num = [2] + kernel_num
         self.masking_mode = masking_mode
+        self.direct_mapping = masking_mode == 'Direct(None make)'
+        self.skip_type = skip_type
 
         # bidirectional=True
         bidirectional = False
@@ -397,7 +560,7 @@ class CRN(nn.Module):
         )
         self.tranform = nn.Linear(self.rnn_units, self.rnn_input_size)
 
-        if cfg.skip_type:
+        if self.skip_type:
             for idx in range(len(self.kernel_num) - 1, 0, -1):
                 if idx != 1:
                     self.decoder.append(
@@ -464,15 +627,19 @@ class CRN(nn.Module):
         if isinstance(self.enhance, nn.LSTM):
             self.enhance.flatten_parameters()
 
-    def forward(self, inputs, targets=0):
-        mags, phase = self.stft(inputs)
+    def forward(self, inputs) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: [B, T] noisy wav
+        returns: the enhanced mags [B, F, T'] (masked, or mapped in 'Direct(None make)') and wav [B, T]
+        """
+        mags, phase = self.stft.mag_phase(inputs)
 
         out = mags
         out = out.unsqueeze(1)
         out = out[:, :, 1:]
         encoder_out = []
 
-        for idx, layer in enumerate(self.encoder):
+        for layer in self.encoder:
             out = layer(out)
             #    print('encoder', out.size())
             encoder_out.append(out)
@@ -487,49 +654,42 @@ class CRN(nn.Module):
 
         out = out.permute(1, 2, 3, 0)
 
-        if cfg.skip_type:  # use skip connection
-            for idx in range(len(self.decoder)):
+        if self.skip_type:  # use skip connection
+            for idx, layer in enumerate(self.decoder):
                 out = torch.cat([out, encoder_out[-1 - idx]], 1)
-                out = self.decoder[idx](out)
+                out = layer(out)
                 out = out[..., 1:]  #
         else:
-            for idx in range(len(self.decoder)):
-                out = self.decoder[idx](out)
+            for layer in self.decoder:
+                out = layer(out)
                 out = out[..., 1:]
 
         # mask_mags = F.pad(out, [0, 0, 1, 0])
         out = out.squeeze(1)
         out = F.pad(out, [0, 0, 1, 0])
 
-        # for loss calculation
-        target_mags, _ = self.stft(targets)
-
-        if self.masking_mode == 'Direct(None make)':  # spectral mapping
-            out_real = out * torch.cos(phase)
-            out_imag = out * torch.sin(phase)
-
-            out_spec = torch.cat([out_real, out_imag], 1)
-
-            out_wav = self.istft(out_spec)
-            out_wav = torch.squeeze(out_wav, 1)
-            out_wav = torch.clamp_(out_wav, -1, 1)
-
-            return out, target_mags, out_wav
+        if self.direct_mapping:  # spectral mapping
+            est_mags = out
         else:  # T-F masking
             # mask_mags = torch.clamp_(mask_mags,0,100)
             # out = F.pad(out, [0, 0, 1, 0])
             mask_mags = torch.tanh(out)
             est_mags = mask_mags * mags
-            out_real = est_mags * torch.cos(phase)
-            out_imag = est_mags * torch.sin(phase)
+        out_real = est_mags * torch.cos(phase)
+        out_imag = est_mags * torch.sin(phase)
 
-            out_spec = torch.cat([out_real, out_imag], 1)
+        out_spec = torch.cat([out_real, out_imag], 1)
 
-            out_wav = self.istft(out_spec)
-            out_wav = torch.squeeze(out_wav, 1)
-            out_wav = torch.clamp_(out_wav, -1, 1)
+        out_wav = self.istft(out_spec)
+        out_wav = torch.squeeze(out_wav, 1)
+        out_wav = torch.clamp_(out_wav, -1, 1)
 
-            return est_mags, target_mags, out_wav
+        return est_mags, out_wav
+
+    def target_spec(self, targets):
+        """mags [B, F, T'] of the clean spec (for the loss)"""
+        target_mags, _ = self.stft.mag_phase(targets)
+        return target_mags
 
     def get_params(self, weight_decay=0.0):
         # add L2 penalty
@@ -548,21 +708,24 @@ class CRN(nn.Module):
         }]
         return params
 
-    def loss(self, estimated, target, out_mags=0, target_mags=0, perceptual=False):
+    def loss(self, estimated, target, out_mags=0, target_mags=None, perceptual=False, mask=None):
         if perceptual:
             if cfg.perceptual == 'LMS':
-                return get_array_lms_loss(target_mags, out_mags)
+                if target_mags is None:
+                    target_mags = self.target_spec(target)
+                # the tanh mask can be negative: the magnitude of the enhanced spec is abs (no log of a negative)
+                return get_array_lms_loss(target_mags, torch.abs(out_mags))
             elif cfg.perceptual == 'PMSQE':
                 return get_array_pmsqe_loss(target, estimated)
         else:
             if cfg.loss == 'MSE':
-                return F.mse_loss(estimated, target, reduction='mean')
+                return mse(estimated, target, mask)
             elif cfg.loss == 'SDR':
-                return -sdr(target, estimated)
+                return -sdr(target, estimated, mask=mask)
             elif cfg.loss == 'SI-SNR':
-                return -(si_snr(estimated, target))
+                return -(si_snr(estimated, target, mask=mask))
             elif cfg.loss == 'SI-SDR':
-                return -(si_sdr(target, estimated))
+                return -(si_sdr(target, estimated, mask=mask))
 
             
 class FullSubNet(BaseModel):
@@ -578,6 +741,9 @@ class FullSubNet(BaseModel):
                  sb_model_hidden_size=cfg.sb_model_hidden_size,
                  weight_init=cfg.weight_init,
                  norm_type=cfg.norm_type,
+                 sb_chunk_size=cfg.sb_chunk_size,
+                 sb_inference_chunk_size=cfg.sb_inference_chunk_size,
+                 sb_freq_ratio=cfg.sb_freq_ratio,
                  ):
         """
         FullSubNet model (cIRM mask)
@@ -591,6 +757,12 @@ class FullSubNet(BaseModel):
             fb_output_activate_function: fullband model's activation function
             sb_output_activate_function: subband model's activation function
             norm_type: type of normalization, see more details in "BaseModel" class
+            sb_chunk_size: number of the freqs given to the sub-band model at once in training (None: all),
+                           each chunk is recomputed in the backward (less memory, more time)
+            sb_inference_chunk_size: the same in eval mode (None: all), the sub-band model streams over the chunks
+                                     of the freqs with the same outputs, so the memory does not grow with F
+            sb_freq_ratio: rate of the freqs of the sub-band model in training (1: all),
+                           random freqs of each sample at each step (see sample_freqs)
         """
         super().__init__()
         assert sequence_model in ("GRU", "LSTM"), f"{self.__class__.__name__} only support GRU and LSTM."
@@ -618,31 +790,49 @@ class FullSubNet(BaseModel):
         self.sb_num_neighbors = sb_num_neighbors
         self.fb_num_neighbors = fb_num_neighbors
         self.look_ahead = look_ahead
-        self.norm = self.norm_wrapper(norm_type)
+        # BaseModel.norm() selects the normalization by this name (no function attribute: scriptable)
+        self.norm_wrapper(norm_type)  # raises if not supported
+        self.norm_type = norm_type
+        # 0: all the freqs
+        self.sb_chunk_size = sb_chunk_size if sb_chunk_size is not None else 0
+        self.sb_inference_chunk_size = sb_inference_chunk_size if sb_inference_chunk_size is not None else 0
+        self.sb_freq_ratio = sb_freq_ratio
 
         if weight_init:
             self.apply(self.weight_init)
 
-    def forward(self, noisy_mag):
+    def forward(self, noisy_mag, freqs: Optional[torch.Tensor] = None, lengths: Optional[torch.Tensor] = None):
         """
         Args:
             noisy_mag: noisy magnitude spectrogram
+            freqs: the freqs of each sample for the sub-band model (None: all), see sample_freqs
+            lengths: the number of valid frames of each sample in a padded batch (None: no padding),
+                     the statistics of the offline norms leave out the padding
 
         Returns:
             The real part and imag part of the enhanced spectrogram
 
         Shapes:
             noisy_mag: [B, 1, F, T]
-            return: [B, 2, F, T]
+            freqs: [B, K]
+            lengths: [B]
+            return: [B, F, T, 2] ([B, K, T, 2] with freqs)
         """
         if not noisy_mag.dim() == 4:
             noisy_mag = noisy_mag.unsqueeze(1)
         noisy_mag = F.pad(noisy_mag, [0, self.look_ahead])  # Pad the look ahead
         batch_size, num_channels, num_freqs, num_frames = noisy_mag.size()
-        assert num_channels == 1, f"{self.__class__.__name__} takes the mag feature as inputs."
+        assert num_channels == 1, "FullSubNet takes the mag feature as inputs."
+
+        # [B, 1, 1, T] the valid frames and their look ahead
+        mask: Optional[torch.Tensor] = None
+        if lengths is not None:
+            steps = torch.arange(num_frames, device=noisy_mag.device)
+            mask = (steps[None, :] < lengths[:, None] + self.look_ahead).to(noisy_mag.dtype)
+            mask = mask.reshape(batch_size, 1, 1, num_frames)
 
         # Fullband model
-        fb_input = self.norm(noisy_mag).reshape(batch_size, num_channels * num_freqs, num_frames)
+        fb_input = self.norm(noisy_mag, mask).reshape(batch_size, num_channels * num_freqs, num_frames)
         fb_output = self.fb_model(fb_input).reshape(batch_size, 1, num_freqs, num_frames)
 
         # Unfold fullband model's output, [B, N=F, C, F_f, T]. N is the number of sub-band units
@@ -650,34 +840,70 @@ class FullSubNet(BaseModel):
         fb_output_unfolded = fb_output_unfolded.reshape(batch_size, num_freqs, self.fb_num_neighbors * 2 + 1, num_frames)
 
         # Unfold noisy spectrogram, [B, N=F, C, F_s, T]
+        # (views of the spectrogram: the sub-band input is built for each chunk of the freqs in sub_band)
         noisy_mag_unfolded = self.unfold(noisy_mag, num_neighbor=self.sb_num_neighbors)
         noisy_mag_unfolded = noisy_mag_unfolded.reshape(batch_size, num_freqs, self.sb_num_neighbors * 2 + 1, num_frames)
+        mu, std = self.sub_band_statistics(noisy_mag_unfolded, fb_output_unfolded, mask)
+        if freqs is not None:
+            # the statistics of the norm are still of all the freqs
+            noisy_mag_unfolded = self.select_freqs(noisy_mag_unfolded, freqs)
+            fb_output_unfolded = self.select_freqs(fb_output_unfolded, freqs)
+            num_freqs = freqs.size(1)
+
+        chunk_size = self.sb_chunk_size if self.training else self.sb_inference_chunk_size
+        if chunk_size <= 0:
+            chunk_size = num_freqs
+        sb_masks = []
+        for start in range(0, num_freqs, chunk_size):
+            end = min(start + chunk_size, num_freqs)
+            if self.training and chunk_size < num_freqs and not torch.jit.is_scripting():
+                sb_masks.append(self.checkpoint_sub_band(noisy_mag_unfolded, fb_output_unfolded, mu, std, start, end))
+            else:
+                sb_masks.append(self.sub_band(noisy_mag_unfolded, fb_output_unfolded, mu, std, start, end))
 
-        # Concatenation, [B, F, (F_s + F_f), T]
-        sb_input = torch.cat([noisy_mag_unfolded, fb_output_unfolded], dim=2)
-        sb_input = self.norm(sb_input)
-
-        sb_input = sb_input.reshape(
-            batch_size * num_freqs,
-            (self.sb_num_neighbors * 2 + 1) + (self.fb_num_neighbors * 2 + 1),
-            num_frames
-        )
-
-        # [B * F, (F_s + F_f), T] => [B * F, 2, T] => [B, F, 2, T]
-        sb_mask = self.sb_model(sb_input)
-        sb_mask = sb_mask.reshape(batch_size, num_freqs, 2, num_frames).permute(0, 2, 1, 3).contiguous()
+        # [B, F, 2, T] => [B, 2, F, T]
+        sb_mask = torch.cat(sb_masks, dim=1).permute(0, 2, 1, 3).contiguous()
 
         output = sb_mask[:, :, :, self.look_ahead:]
         output = output.permute(0, 2, 3, 1)
         return output
 
-    def loss(self, estimated, target):
+    def sample_freqs(self, noisy_mag):
+        """random freqs [B, K] of each sample for the frequency subsampling in training, None if not used"""
+        if not self.training or self.sb_freq_ratio >= 1:
+            return None
+        batch_size, num_freqs = noisy_mag.size(0), noisy_mag.size(-2)
+        return self._reduce_complexity_separately(batch_size, num_freqs, self.sb_freq_ratio, noisy_mag.device)
+
+    def sub_band(self, noisy_mag_unfolded, fb_output_unfolded, mu, std, start: int, end: int):
+        """
+        sub-band model for the freqs [start, end)
+
+        Returns:
+            [B, end - start, 2, T] cIRM
+        """
+        # Concatenation, [B, F, (F_s + F_f), T]
+        sb_input = torch.cat([noisy_mag_unfolded[:, start:end], fb_output_unfolded[:, start:end]], dim=2)
+        sb_input = self.sub_band_norm(sb_input, mu, std)
+        batch_size, num_freqs, num_channels, num_frames = sb_input.size()
+
+        # [B * F, (F_s + F_f), T] => [B * F, 2, T] => [B, F, 2, T]
+        sb_mask = self.sb_model(sb_input.reshape(batch_size * num_freqs, num_channels, num_frames))
+        return sb_mask.reshape(batch_size, num_freqs, 2, num_frames)
+
+    @torch.jit.unused
+    def checkpoint_sub_band(self, noisy_mag_unfolded, fb_output_unfolded, mu, std, start: int, end: int):
+        # the activations of the chunk are not kept, recomputed in the backward
+        return checkpoint(self.sub_band, noisy_mag_unfolded, fb_output_unfolded, mu, std, start, end,
+                          use_reentrant=False)
+
+    def loss(self, estimated, target, mask=None):
             if cfg.loss == 'MSE':
-                return F.mse_loss(estimated, target, reduction='mean')
+                return mse(estimated, target, mask)
             elif cfg.loss == 'SDR':
-                return -sdr(target, estimated)
+                return -sdr(target, estimated, mask=mask)
             elif cfg.loss == 'SI-SNR':
-                return -(si_snr(estimated, target))
+                return -(si_snr(estimated, target, mask=mask))
             elif cfg.loss == 'SI-SDR':
-                return -(si_sdr(target, estimated))
+                return -(si_sdr(target, estimated, mask=mask))
             
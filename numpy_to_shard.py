@@ -0,0 +1,28 @@
+"""
+convert a legacy object .npy dataset ([noisy, clean] pairs) to the sharded dataset format
+"""
+import sys
+import time
+from tools_for_dataset import convert_object_array
+
+
+def main():
+    argvs = sys.argv[1:]
+    if len(argvs) not in (2, 3):
+        print('Error: Invalid input arguments')
+        print('\t Usage: python numpy_to_shard.py [npy] [dataset_dir] [dtype]')
+        print("\t\t [npy]: './Dataset/train_dataset_norm_tv31_snr51015.npy', ...")
+        print("\t\t [dataset_dir]: './Dataset/train_dataset_norm_tv31_snr51015', ...")
+        print("\t\t [dtype]: 'float32' (default), 'int16'")
+        exit()
+    npy_path = argvs[0]
+    dataset_dir = argvs[1]
+    dtype = argvs[2] if len(argvs) == 3 else 'float32'
+
+    st_time = time.time()
+    num_pairs = convert_object_array(npy_path, dataset_dir, dtype=dtype)
+    print('{} pairs are converted... takes {:.4} seconds...'.format(num_pairs, time.time() - st_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Batched data augmentation for the training
+
+The augmentations of data_augmentation.py (shifting, minus, reverse) plus gain and SNR jitter,
+applied to a whole batch with tensor operations instead of writing augmented copies of the data.
+Every transform is applied to each sample with its own probability,
+and to the noisy input and the clean target in the same way (except the SNR jitter).
+It runs on the CPU in the dataloader workers (collate_fn) or on DEVICE in the trainer.
+"""
+import torch
+import config as cfg
+
+
+############################################################################
+#                            for each transform                            #
+############################################################################
+def choose(batch_size, prob, device):
+    # [B] True for the samples to transform
+    return (torch.rand(batch_size) < prob).to(device)
+
+
+def uniform(batch_size, low, high, device):
+    return (low + (high - low) * torch.rand(batch_size)).to(device)
+
+
+# Minus the sound : 위상을 뒤집는 것으로, 원래 소리와 똑같이 들림.
+def minus_sound(inputs, targets, selected):
+    sign = 1 - 2 * selected.to(inputs.dtype)[:, None]
+    return inputs * sign, targets * sign
+
+
+def valid_lengths(inputs, lengths):
+    # [B] length of each sample without the padding
+    if lengths is None:
+        return torch.full((inputs.size(0),), inputs.size(-1), dtype=torch.long, device=inputs.device)
+    return lengths.to(inputs.device).long()
+
+
+# 음성의 순서를 회전함 (circular shift by a different amount for each sample)
+# padded batch: only the valid part of each sample is rotated, the padding stays at the end
+def shifting_sound(inputs, targets, selected, shift_range, lengths=None):
+    batch_size, length = inputs.size()
+    lengths = valid_lengths(inputs, lengths)
+    roll_rate = uniform(batch_size, shift_range[0], shift_range[1], inputs.device)
+    shift = (roll_rate * lengths).long() * selected.long()
+    steps = torch.arange(length, device=inputs.device)[None, :]
+    valid = steps < lengths[:, None]
+    index = torch.where(valid, (steps - shift[:, None]) % lengths.clamp(min=1)[:, None], steps)
+    return inputs.gather(1, index), targets.gather(1, index)
+
+
+# Reverse the sound
+def reverse_sound(inputs, targets, selected, lengths=None):
+    length = inputs.size(-1)
+    lengths = valid_lengths(inputs, lengths)
+    steps = torch.arange(length, device=inputs.device)[None, :]
+    flip = selected[:, None] & (steps < lengths[:, None])
+    index = torch.where(flip, lengths[:, None] - 1 - steps, steps)
+    return inputs.gather(1, index), targets.gather(1, index)
+
+
+def change_gain(inputs, targets, selected, gain_range):
+    gain_db = uniform(inputs.size(0), gain_range[0], gain_range[1], inputs.device) * selected.to(inputs.dtype)
+    gain = (10 ** (gain_db / 20))[:, None]
+    return inputs * gain, targets * gain
+
+
+def jitter_snr(inputs, targets, selected, snr_range, eps=1e-8):
+    # split the noisy input into the speech (projection on the target) and the rest (noise),
+    # and scale the noise. the peak of the noisy input is kept.
+    scale = torch.sum(inputs * targets, -1, keepdim=True) / (torch.sum(targets ** 2, -1, keepdim=True) + eps)
+    speech = scale * targets
+    noise = inputs - speech
+
+    jitter_db = uniform(inputs.size(0), snr_range[0], snr_range[1], inputs.device) * selected.to(inputs.dtype)
+    noisy = speech + noise * (10 ** (-jitter_db / 20))[:, None]
+
+    peak = torch.max(torch.abs(inputs), -1, keepdim=True)[0]
+    noisy = noisy / (torch.max(torch.abs(noisy), -1, keepdim=True)[0] + eps) * peak
+    return noisy, targets
+
+
+############################################################################
+#                                for batch                                 #
+############################################################################
+class Augmentation(object):
+    """
+    Args:
+        minus, shift, reverse, gain, snr_jitter: probability of each transform (0: not used)
+        shift_range: range of the shift, rate of the length
+        gain_range: range of the gain (dB)
+        snr_range: range of the SNR change (dB)
+    """
+
+    def __init__(self, minus=0., shift=0., reverse=0., gain=0., snr_jitter=0.,
+                 shift_range=(0., 1.), gain_range=(-6., 0.), snr_range=(-5., 5.)):
+        self.minus = minus
+        self.shift = shift
+        self.reverse = reverse
+        self.gain = gain
+        self.snr_jitter = snr_jitter
+        self.shift_range = shift_range
+        self.gain_range = gain_range
+        self.snr_range = snr_range
+
+    def __call__(self, inputs, targets, lengths=None):
+        """
+        inputs: [B, T] noisy
+        targets: [B, T] clean
+        lengths: [B] valid length of each sample in a padded batch (None: no padding)
+        """
+        batch_size = inputs.size(0)
+        device = inputs.device
+        if self.snr_jitter > 0:
+            inputs, targets = jitter_snr(inputs, targets, choose(batch_size, self.snr_jitter, device), self.snr_range)
+        if self.minus > 0:
+            inputs, targets = minus_sound(inputs, targets, choose(batch_size, self.minus, device))
+        if self.shift > 0:
+            inputs, targets = shifting_sound(inputs, targets, choose(batch_size, self.shift, device),
+                                             self.shift_range, lengths)
+        if self.reverse > 0:
+            inputs, targets = reverse_sound(inputs, targets, choose(batch_size, self.reverse, device), lengths)
+        if self.gain > 0:
+            inputs, targets = change_gain(inputs, targets, choose(batch_size, self.gain, device), self.gain_range)
+        return inputs, targets
+
+
+class AugmentedCollate(object):
+    """collate_fn of the dataloader: pad the batch (see dataloader.pad_collate), then augment it in the worker"""
+
+    def __init__(self, augmentation, collate_fn):
+        self.augmentation = augmentation
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        inputs, targets, lengths = self.collate_fn(batch)
+        inputs, targets = self.augmentation(inputs.float(), targets.float(), lengths)
+        return inputs, targets, lengths
+
+
+def create_augmentation():
+    """Augmentation from config, None if every probability is 0"""
+    if not any(prob > 0 for prob in cfg.augmentation.values()):
+        return None
+    return Augmentation(shift_range=cfg.shift_range, gain_range=cfg.gain_range, snr_range=cfg.snr_jitter_range,
+                        **cfg.augmentation)
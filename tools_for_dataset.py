@@ -0,0 +1,327 @@
+"""
+Sharded, memory-mapped dataset format
+
+A dataset is a directory with a manifest and one or more shards.
+Each shard keeps the samples of many utterances back to back in flat arrays,
+and an offset index tells where each utterance starts and ends.
+
+    <dataset>/manifest.json            {"version": 1, "streams": ["noisy", "clean"], "shards": ["shard_00000", ...]}
+    <dataset>/shard_00000/noisy.npy    [total samples] float32 or int16
+    <dataset>/shard_00000/clean.npy    [total samples] float32 or int16
+    <dataset>/shard_00000/offsets.npy  [utterances + 1] int64
+    <dataset>/shard_00000/keys.txt     one name per utterance
+
+The arrays are opened with np.load(mmap_mode), so reading an utterance is only
+a slice of the mapped file and every process on the box shares the page cache
+instead of unpickling its own copy of the whole object array.
+
+The streams are 'noisy' and 'clean' for the training pairs,
+and a single 'samples' stream for a corpus of clean speech or noise.
+"""
+import os
+import csv
+import json
+import shutil
+import numpy as np
+from collections import OrderedDict
+
+MANIFEST_NAME = 'manifest.json'
+SHARD_SIZE = 2 ** 26  # samples per shard (256 MB with float32)
+INT16_SCALE = 32768
+STREAMS = ('noisy', 'clean')
+
+
+############################################################################
+#                              for reading                                 #
+############################################################################
+def is_sharded_dataset(path):
+    return os.path.isfile(os.path.join(str(path), MANIFEST_NAME))
+
+
+def read_manifest(dataset_dir):
+    with open(os.path.join(str(dataset_dir), MANIFEST_NAME), 'r') as f:
+        return json.load(f)
+
+
+def shard_paths(dataset_dir):
+    """Absolute path of every shard in the manifest.
+    Shards are stored relative to the dataset directory, so a manifest can also point to
+    the shards of another dataset (e.g. '../train_ori/shard_00000').
+    """
+    manifest = read_manifest(dataset_dir)
+    return [os.path.normpath(os.path.join(str(dataset_dir), shard)) for shard in manifest['shards']]
+
+
+def read_keys(shard_dir):
+    keys_path = os.path.join(shard_dir, 'keys.txt')
+    if not os.path.exists(keys_path):
+        return []
+    with open(keys_path, 'r') as f:
+        return f.read().splitlines()
+
+
+class ShardedPairs(object):
+    """[noisy, clean] pairs of a sharded dataset (or the samples of a corpus, one stream per item).
+
+    Only the offset index is loaded in __init__. The sample arrays are memory-mapped
+    the first time a shard is touched, so the object stays cheap to create and to copy.
+    """
+
+    def __init__(self, dataset_dir, mmap_mode='c'):
+        self.dataset_dir = str(dataset_dir)
+        self.mmap_mode = mmap_mode  # 'c': copy-on-write, shares the page cache but gives writable views
+        self.streams = tuple(read_manifest(self.dataset_dir).get('streams', STREAMS))
+        self.shards = shard_paths(self.dataset_dir)
+
+        shard_of, starts, lengths = [], [], []
+        for shard_idx, shard_dir in enumerate(self.shards):
+            offsets = np.load(os.path.join(shard_dir, 'offsets.npy'))
+            shard_of.append(np.full(len(offsets) - 1, shard_idx, dtype=np.int64))
+            starts.append(offsets[:-1])
+            lengths.append(np.diff(offsets))
+        self.shard_of = np.concatenate(shard_of) if shard_of else np.zeros(0, dtype=np.int64)
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        self.lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+
+        self._arrays = [None] * len(self.shards)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _open(self, shard_idx):
+        if self._arrays[shard_idx] is None:
+            shard_dir = self.shards[shard_idx]
+            self._arrays[shard_idx] = tuple(np.load(os.path.join(shard_dir, stream + '.npy'), mmap_mode=self.mmap_mode)
+                                            for stream in self.streams)
+        return self._arrays[shard_idx]
+
+    def read(self, idx, start=0, length=None):
+        """Read [start, start + length) samples of the utterance 'idx' without touching the rest."""
+        utt_len = int(self.lengths[idx])
+        if length is None:
+            length = utt_len - start
+        begin = int(self.starts[idx]) + start
+        end = begin + min(length, utt_len - start)
+
+        arrays = self._open(int(self.shard_of[idx]))
+        return tuple(to_float(array[begin:end]) for array in arrays)
+
+    def __getitem__(self, idx):
+        return self.read(idx)
+
+    def __getstate__(self):
+        # DataLoader workers get only the index, and map the shards again by themselves
+        # (pickling the opened memmaps would copy all the samples into every worker)
+        state = self.__dict__.copy()
+        state['_arrays'] = [None] * len(self.shards)
+        return state
+
+
+def to_float(samples):
+    # float32 shards are returned as views, int16 shards are scaled to [-1, 1)
+    if samples.dtype == np.int16:
+        return samples.astype(np.float32) / INT16_SCALE
+    return samples
+
+
+def normalization(wav):
+    # peak normalization of the noisy and clean data
+    return wav / (np.max(np.abs(wav), axis=-1, keepdims=True) + 1e-7)
+
+
+def load_pairs(path):
+    """Load [noisy, clean] pairs either from a sharded dataset or from a legacy object .npy file."""
+    path = str(path)
+    if is_sharded_dataset(path):
+        return ShardedPairs(path)
+    if not os.path.exists(path) and os.path.exists(path + '.npy'):
+        path = path + '.npy'
+    # legacy format: the data was saved as an object array
+    return np.load(path, allow_pickle=True)
+
+
+############################################################################
+#                         for mixture manifest                             #
+############################################################################
+# The generation of the noisy data writes 'manifest.csv' in the noisy directory,
+# one row for each noisy file. The pairs are read from it, instead of scanning the directories
+# and parsing the file names.
+MIXTURE_MANIFEST_NAME = 'manifest.csv'
+MIXTURE_FIELDS = ['noisy', 'clean', 'noise', 'snr', 'offset', 'length']
+
+
+def read_mixture_manifest(path):
+    """[{'noisy': .., 'clean': .., 'noise': .., 'snr': int, 'offset': int, 'length': int}, ...]"""
+    with open(str(path), 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for field in ('snr', 'offset', 'length'):
+            row[field] = int(row[field])
+    return rows
+
+
+def write_mixture_manifest(path, rows):
+    """Write the rows, keeping the rows of other noisy files that are already in the manifest."""
+    path = str(path)
+    merged = OrderedDict()
+    if os.path.exists(path):
+        for row in read_mixture_manifest(path):
+            merged[row['noisy']] = row
+    for row in rows:
+        merged[row['noisy']] = row
+
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MIXTURE_FIELDS)
+        writer.writeheader()
+        writer.writerows(merged.values())
+    os.replace(path + '.tmp', path)
+
+
+############################################################################
+#                              for writing                                 #
+############################################################################
+def write_manifest(dataset_dir, manifest):
+    # write to a temporary file first, so an interrupted run never leaves a broken manifest
+    manifest_path = os.path.join(str(dataset_dir), MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def new_manifest(streams=STREAMS):
+    return {'version': 1, 'streams': list(streams), 'shards': []}
+
+
+class ShardWriter(object):
+    """Append [noisy, clean] pairs (or the items of other 'streams') to a (new or existing) sharded dataset.
+
+    Items are buffered until 'shard_size' samples are collected, then written as a new shard
+    and registered in the manifest. A shard is only visible after it was completely written.
+    """
+
+    def __init__(self, dataset_dir, dtype='float32', shard_size=SHARD_SIZE, streams=STREAMS):
+        assert dtype in ('float32', 'int16'), "dtype should be 'float32' or 'int16'"
+        self.dataset_dir = str(dataset_dir)
+        self.dtype = dtype
+        self.shard_size = shard_size
+
+        if not os.path.exists(self.dataset_dir):
+            os.makedirs(self.dataset_dir)
+        if is_sharded_dataset(self.dataset_dir):
+            self.manifest = read_manifest(self.dataset_dir)
+            assert tuple(self.manifest.get('streams', STREAMS)) == tuple(streams), \
+                "'%s' has the streams %s" % (self.dataset_dir, self.manifest.get('streams', STREAMS))
+        else:
+            self.manifest = new_manifest(streams)
+            write_manifest(self.dataset_dir, self.manifest)
+        self.streams = tuple(streams)
+
+        # remove the leftovers of an interrupted run
+        for name in os.listdir(self.dataset_dir):
+            if name.endswith('.tmp') and os.path.isdir(os.path.join(self.dataset_dir, name)):
+                shutil.rmtree(os.path.join(self.dataset_dir, name))
+
+        self._reset()
+
+    def _reset(self):
+        self._buffers = [[] for _ in self.streams]
+        self._keys = []
+        self._num_samples = 0
+
+    def _next_shard_name(self):
+        idx = 0
+        while os.path.exists(os.path.join(self.dataset_dir, 'shard_%05d' % idx)):
+            idx += 1
+        return 'shard_%05d' % idx
+
+    def _cast(self, samples):
+        samples = np.asarray(samples, dtype=np.float32)
+        if self.dtype == 'int16':
+            return np.clip(np.round(samples * INT16_SCALE), -INT16_SCALE, INT16_SCALE - 1).astype(np.int16)
+        return samples
+
+    def keys(self):
+        """Keys of all pairs already written in this dataset (for resuming a conversion)."""
+        keys = set()
+        for shard_dir in shard_paths(self.dataset_dir):
+            keys.update(read_keys(shard_dir))
+        return keys
+
+    def add(self, key, *samples):
+        """add(key, noisy, clean) for the pairs, add(key, samples) for a corpus"""
+        assert len(samples) == len(self.streams), "%d streams are expected" % len(self.streams)
+        assert all(len(x) == len(samples[0]) for x in samples), \
+            "the streams of '%s' have different lengths %s" % (key, [len(x) for x in samples])
+        for buffer, x in zip(self._buffers, samples):
+            buffer.append(self._cast(x))
+        self._keys.append(str(key))
+        self._num_samples += len(samples[0])
+
+        if self._num_samples >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._keys:
+            return
+        name = self._next_shard_name()
+        tmp_dir = os.path.join(self.dataset_dir, name + '.tmp')
+        os.makedirs(tmp_dir)
+
+        offsets = np.zeros(len(self._keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in self._buffers[0]])
+        for stream, buffer in zip(self.streams, self._buffers):
+            np.save(os.path.join(tmp_dir, stream + '.npy'), np.concatenate(buffer))
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_dir, 'keys.txt'), 'w') as f:
+            f.write('\n'.join(self._keys) + '\n')
+
+        os.rename(tmp_dir, os.path.join(self.dataset_dir, name))
+        self.manifest['shards'].append(name)
+        write_manifest(self.dataset_dir, self.manifest)
+        self._reset()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def convert_object_array(npy_path, dataset_dir, dtype='float32', shard_size=SHARD_SIZE):
+    """Convert a legacy [N, 2] object .npy file ([noisy, clean] pairs) to a sharded dataset."""
+    pairs = np.load(str(npy_path), allow_pickle=True)
+    with ShardWriter(dataset_dir, dtype=dtype, shard_size=shard_size) as writer:
+        for idx in range(len(pairs)):
+            writer.add('%s:%d' % (os.path.basename(str(npy_path)), idx), pairs[idx][0], pairs[idx][1])
+    return len(pairs)
+
+
+def merge_datasets(dataset_dir, sources):
+    """Append the sources to the dataset 'dataset_dir' (created if needed) without copying samples.
+
+    A sharded source is added by pointing the manifest at its shards, so the cost does not depend on
+    the size of the data. A legacy .npy source is converted into new shards of 'dataset_dir'.
+    """
+    dataset_dir = str(dataset_dir)
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+    manifest = read_manifest(dataset_dir) if is_sharded_dataset(dataset_dir) else new_manifest()
+    write_manifest(dataset_dir, manifest)
+
+    for source in sources:
+        source = str(source)
+        if is_sharded_dataset(source):
+            assert tuple(read_manifest(source).get('streams', STREAMS)) == tuple(manifest.get('streams', STREAMS)), \
+                "'%s' has different streams from '%s'" % (source, dataset_dir)
+            for shard_dir in shard_paths(source):
+                shard = os.path.relpath(shard_dir, dataset_dir)
+                if shard not in manifest['shards']:
+                    manifest['shards'].append(shard)
+            write_manifest(dataset_dir, manifest)
+        else:
+            convert_object_array(source, dataset_dir)
+            manifest = read_manifest(dataset_dir)
+    return manifest
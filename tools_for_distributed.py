@@ -0,0 +1,92 @@
+"""
+Distributed data-parallel (DDP) training
+
+Run train_interface.py with torchrun, one process for each GPU (or CPU worker):
+    torchrun --nproc_per_node=4 train_interface.py
+    torchrun --nnodes=2 --node_rank=0 --master_addr=HOST --nproc_per_node=4 train_interface.py
+Without torchrun (no RANK / WORLD_SIZE in the environment), it runs in a single process as before.
+Every process trains on its own part of the data (DistributedSampler) with cfg.batch,
+so the effective batch is cfg.batch * world size.
+Only the process of rank 0 saves the checkpoints, writes the log and the tensorboard.
+"""
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+import config as cfg
+
+
+def init_distributed():
+    """Join the process group if launched by torchrun. Returns the device of this process"""
+    if 'WORLD_SIZE' not in os.environ or int(os.environ['WORLD_SIZE']) <= 1:
+        return torch.device(cfg.DEVICE)
+
+    device = torch.device(cfg.DEVICE)
+    if device.type == 'cuda':
+        # one GPU for each process
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend=cfg.dist_backend)
+    return device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, DEVICE):
+    """DistributedDataParallel (and SyncBatchNorm with cfg.sync_bn), the model itself if not distributed"""
+    if not is_distributed():
+        return model
+    if cfg.sync_bn:
+        # only nn.BatchNorm layers are converted (not ComplexBatchNorm), and it needs the GPUs
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    if DEVICE.type == 'cuda':
+        return DistributedDataParallel(model, device_ids=[DEVICE.index], output_device=DEVICE.index)
+    return DistributedDataParallel(model)
+
+
+def unwrap(model):
+    # the original model under DistributedDataParallel and torch.compile (e.g. for model.loss)
+    while True:
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        elif hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        else:
+            return model
+
+
+def reduce_sum(value):
+    """sum of a number (or tensor) over all the processes"""
+    if not is_distributed():
+        return value
+    tensor = torch.as_tensor(value, dtype=torch.float64).clone()
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.cpu() if torch.is_tensor(value) else tensor.item()
+
+
+def reduce_mean(value):
+    """mean of a number (or tensor) over all the processes"""
+    if not is_distributed():
+        return value
+    return reduce_sum(value) / get_world_size()
@@ -1,5 +1,6 @@
 import torch
 import math
+import functools
 import numpy as np
 import config as cfg
 from asteroid.losses import SingleSrcPMSQE, PITLossWrapper
@@ -26,14 +27,21 @@ def sdr_linear(s1, s2, eps=1e-8):
     return torch.mean(sdr_loss)
 
 
-def sdr(s1, s2, eps=1e-8):
+# the losses are computed in fp32 (also under autocast), float16 log10 and sums are not accurate enough
+def sdr(s1, s2, eps=1e-8, mask=None):
+    s1, s2 = s1.float(), s2.float()
+    if mask is not None:
+        s1, s2 = s1 * mask, s2 * mask
     sn = l2_norm(s1, s1)
     sn_m_shn = l2_norm(s1 - s2, s1 - s2)
     sdr_loss = 10 * torch.log10(sn**2 / (sn_m_shn**2 + eps))
     return torch.mean(sdr_loss)
 
 
-def si_snr(s1, s2, eps=1e-8):
+def si_snr(s1, s2, eps=1e-8, mask=None):
+    s1, s2 = s1.float(), s2.float()
+    if mask is not None:
+        s1, s2 = s1 * mask, s2 * mask
     s1_s2_norm = l2_norm(s1, s2)
     s2_s2_norm = l2_norm(s2, s2)
     s_target = s1_s2_norm / (s2_s2_norm + eps) * s2
@@ -44,7 +52,7 @@ def si_snr(s1, s2, eps=1e-8):
     return torch.mean(snr)
 
 
-def si_sdr(reference, estimation, eps=1e-8):
+def si_sdr(reference, estimation, eps=1e-8, mask=None):
     """
         Scale-Invariant Signal-to-Distortion Ratio (SI-SDR)
         Args:
@@ -75,7 +83,11 @@ def si_sdr(reference, estimation, eps=1e-8):
         :param reference:
         :param estimation:
         :param eps:
+        :param mask: [..., T] (1: valid, 0: padding), broadcast to the inputs
         """
+    reference, estimation = reference.float(), estimation.float()
+    if mask is not None:
+        reference, estimation = reference * mask, estimation * mask
 
     reference_energy = torch.sum(reference ** 2, axis=-1, keepdims=True)
 
@@ -94,6 +106,38 @@ def si_sdr(reference, estimation, eps=1e-8):
     return 10 * torch.log10(ratio + eps)
 
 
+def mse(estimated, target, mask=None):
+    estimated, target = estimated.float(), target.float()
+    if mask is None:
+        return torch.mean((estimated - target) ** 2)
+    # mean over the valid elements only
+    mask = mask.expand_as(estimated)
+    return torch.sum((estimated - target) ** 2 * mask) / torch.sum(mask)
+
+
+############################################################################
+#                    for padded (variable-length) batch                    #
+############################################################################
+def sequence_mask(lengths, max_len):
+    """[B] lengths => [B, max_len] mask (1: valid, 0: padding)"""
+    steps = torch.arange(max_len, device=lengths.device)
+    return (steps[None, :] < lengths[:, None]).float()
+
+
+def frame_lengths(lengths, frame_inc, left_pad):
+    """number of the STFT frames that overlap the valid samples"""
+    return torch.div(lengths + left_pad + frame_inc - 1, frame_inc, rounding_mode='floor')
+
+
+def padding_mask(lengths, max_len):
+    """sequence_mask, or None if nothing is padded (lengths None, see trainer.to_device: the loss runs as before)
+    It does not look at the values of lengths: on the GPU, that would wait for the copy (a host sync).
+    """
+    if lengths is None:
+        return None
+    return sequence_mask(lengths, max_len)
+
+
 ############################################################################
 #                          for LMS loss function                           #
 ############################################################################
@@ -105,9 +149,6 @@ def si_sdr(reference, estimation, eps=1e-8):
 # and some of this code:
 #     http://stackoverflow.com/questions/5835568/...
 #         how-to-get-mfcc-from-an-fft-on-a-signal
-# Set device
-DEVICE = torch.device(cfg.DEVICE)
-
 FFT_SIZE = cfg.fft_len
 
 # multi-scale MFCC distance
@@ -189,13 +230,20 @@ def melFilterBank(numCoeffs, fftSize=None):
 # given a (symbolic Theano) array of size M x WINDOW_SIZE
 # this returns an array M x N where each window has been replaced
 # by some perceptual transform (in this case, MFCC coeffs)
-def perceptual_transform(x):
-    # precompute Mel filterbank: [FFT_SIZE x NUM_MFCC_COEFFS]
+# precompute Mel filterbank: [FFT_SIZE x NUM_MFCC_COEFFS]
+# on the device of the inputs when first used (not at import: each DDP process sets its GPU after the import)
+@functools.lru_cache(maxsize=None)
+def mel_filterbanks(device):
     MEL_FILTERBANKS = []
     for scale in MEL_SCALES:
         filterbank_npy = melFilterBank(scale, FFT_SIZE).transpose()
         torch_filterbank_npy = torch.from_numpy(filterbank_npy).type(torch.FloatTensor)
-        MEL_FILTERBANKS.append(torch_filterbank_npy.to(DEVICE))
+        MEL_FILTERBANKS.append(torch_filterbank_npy.to(device))
+    return MEL_FILTERBANKS
+
+
+def perceptual_transform(x):
+    MEL_FILTERBANKS = mel_filterbanks(x.device)
 
     transforms = []
     # powerSpectrum = torch_dft_mag(x, DFT_REAL, DFT_IMAG)**2
@@ -239,6 +287,18 @@ class perceptual_distance(torch.nn.Module):
 get_mel_loss = perceptual_distance()
 
 
+def fp32(loss_fn):
+    # run the loss in fp32, also under autocast (mixed precision training)
+    @functools.wraps(loss_fn)
+    def wrapper(*args, **kwargs):
+        device = next(arg.device for arg in args if torch.is_tensor(arg))
+        with torch.autocast(device.type, enabled=False):
+            args = [arg.float() if torch.is_tensor(arg) else arg for arg in args]
+            return loss_fn(*args, **kwargs)
+    return wrapper
+
+
+@fp32
 def get_array_lms_loss(clean_array, est_array):
     array_mel_loss = 0
     for i in range(len(clean_array)):
@@ -252,18 +312,25 @@ def get_array_lms_loss(clean_array, est_array):
 ############################################################################
 #                       for pmsqe loss function                            #
 ############################################################################
-pmsqe_stft = Encoder(STFTFB(kernel_size=512, n_filters=512, stride=256)).to(DEVICE)
-pmsqe_loss = PITLossWrapper(SingleSrcPMSQE(), pit_from='pw_pt').to(DEVICE)
+# built on the device of the inputs when first used (see mel_filterbanks)
+@functools.lru_cache(maxsize=None)
+def pmsqe_modules(device):
+    pmsqe_stft = Encoder(STFTFB(kernel_size=512, n_filters=512, stride=256)).to(device)
+    pmsqe_loss = PITLossWrapper(SingleSrcPMSQE(), pit_from='pw_pt').to(device)
+    return pmsqe_stft, pmsqe_loss
 
 
+@fp32
 def get_array_pmsqe_loss(clean_array, est_array):
     if clean_array.dim() == 2:
         clean_wav = torch.unsqueeze(clean_array, 1)
         est_wav = torch.unsqueeze(est_array, 1)
     N, C, H = clean_wav.size()
+    assert H % cfg.fs == 0, 'PMSQE loss takes whole seconds of wav (see dataloader.length_multiple)'
     clean_wav = clean_wav.contiguous().view(N, -1, cfg.fs)
     est_wav = est_wav.contiguous().view(N, -1, cfg.fs)
 
+    pmsqe_stft, pmsqe_loss = pmsqe_modules(clean_wav.device)
     clean_spec = transforms.mag(pmsqe_stft(clean_wav))
     est_spec = transforms.mag(pmsqe_stft(est_wav))
     return pmsqe_loss(est_spec, clean_spec)
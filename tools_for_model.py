@@ -2,10 +2,12 @@ import torch
 import torch.nn as nn
 import numpy as np
 import time
+from collections import OrderedDict
 import torch.nn.functional as F
 import torch.nn.init as init
 from scipy.signal import get_window
 import matplotlib.pylab as plt
+from typing import List, Optional, Tuple
 import config as cfg
 
 
@@ -33,9 +35,27 @@ def init_kernels(win_len, win_inc, fft_len, win_type=None, invers=False):
     return torch.from_numpy(kernel.astype(np.float32)), torch.from_numpy(window[None, :, None].astype(np.float32))
 
 
+def init_fft_inverse(win_len, fft_len):
+    """
+    The inverse kernel of init_kernels is pinv(K) of the truncated DFT K [N+2, win_len]: for the FFT backend,
+        pinv(K) s = (K^T K)^-1 K^T s,   K^T s = N/2 * irfft(s)[:win_len] + U [s_0, s_N/2]^T / 2
+        K^T K = N/2 * I + U U^T / 2,    U = [1, (-1)^n]  ([win_len, 2], aliasing of the DC and the Nyquist bins)
+    (K^T K)^-1 y = (y - W U^T y) / (N/2),  W = U (N * I + U^T U)^-1 (Woodbury identity)
+    returns: U, W [win_len, 2]
+    """
+    assert fft_len % 2 == 0 and win_len <= fft_len, "the fft backend needs an even fft_len >= win_len"
+    basis = np.stack([np.ones(win_len), (-1.) ** np.arange(win_len)], 1)
+    weight = basis @ np.linalg.inv(fft_len * np.eye(2) + basis.T @ basis)
+    return torch.from_numpy(basis.astype(np.float32)), torch.from_numpy(weight.astype(np.float32))
+
+
 class ConvSTFT(nn.Module):
 
-    def __init__(self, win_len, win_inc, fft_len=None, win_type='hamming', feature_type='real', fix=True):
+    def __init__(self, win_len, win_inc, fft_len=None, win_type='hamming', feature_type='real', fix=True,
+                 backend=cfg.stft_backend):
+        '''
+            backend: 'conv' (conv1d with the DFT kernel) or 'fft' (torch.fft.rfft of the windowed frames)
+        '''
         super(ConvSTFT, self).__init__()
 
         if fft_len == None:
@@ -43,34 +63,72 @@ class ConvSTFT(nn.Module):
         else:
             self.fft_len = fft_len
 
-        kernel, _ = init_kernels(win_len, win_inc, self.fft_len, win_type)
+        kernel, window = init_kernels(win_len, win_inc, self.fft_len, win_type)
         # self.weight = nn.Parameter(kernel, requires_grad=(not fix))
         self.register_buffer('weight', kernel)
+        # not in the state_dict: the checkpoints are the same for both backends
+        self.register_buffer('window', window.view(-1), persistent=False)
         self.feature_type = feature_type
         self.stride = win_inc
         self.win_len = win_len
         self.dim = self.fft_len
+        self.backend = backend
 
     def forward(self, inputs):
+        """
+        inputs: [B, T] or [B, 1, T]
+        returns: [B, N+2, T] (complex spec, real and imag)
+        feature_type 'real': use mag_phase() for the mags and phase
+        """
+        # always in fp32 (also under autocast): the spectrum and mags easily overflow float16
+        if torch.jit.is_scripting():
+            return self.transform(inputs)
+        with torch.autocast(inputs.device.type, enabled=False):
+            return self.transform(inputs)
+
+    def transform(self, inputs):
+        inputs = inputs.float()
         if inputs.dim() == 2:
             inputs = torch.unsqueeze(inputs, 1)
         inputs = F.pad(inputs, [self.win_len - self.stride, self.win_len - self.stride])
-        outputs = F.conv1d(inputs, self.weight, stride=self.stride)
-
-        if self.feature_type == 'complex':
-            return outputs
-        else:
-            dim = self.dim // 2 + 1
-            real = outputs[:, :dim, :]
-            imag = outputs[:, dim:, :]
-            mags = torch.sqrt(real ** 2 + imag ** 2)
-            phase = torch.atan2(imag, real)
-            return mags, phase
+        if self.backend == 'fft':
+            return self.fft_stft(inputs)
+        return F.conv1d(inputs, self.weight, stride=self.stride)
+
+    def spectrum(self, frames):
+        """[B, win_len] one frame (no padding) -> [B, N+2], the same as a frame of forward (streaming inference)"""
+        frames = frames.float().unsqueeze(1)
+        if self.backend == 'fft':
+            return self.fft_stft(frames)[..., 0]
+        return F.conv1d(frames, self.weight, stride=self.stride)[..., 0]
+
+    def fft_stft(self, inputs):
+        # [B, 1, T] -> [B, T', win_len] frames (the same frames as conv1d)
+        frames = inputs[:, 0].unfold(-1, self.win_len, self.stride) * self.window
+        spec = torch.fft.rfft(frames, n=self.fft_len)  # [B, T', N//2+1]
+        return torch.cat([spec.real, spec.imag], -1).transpose(1, 2).contiguous()
+
+    def mag_phase(self, inputs) -> Tuple[torch.Tensor, torch.Tensor]:
+        """returns: mags [B, N//2+1, T], phase [B, N//2+1, T]"""
+        outputs = self.forward(inputs)
+        dim = self.dim // 2 + 1
+        real = outputs[:, :dim, :]
+        imag = outputs[:, dim:, :]
+        mags = torch.sqrt(real ** 2 + imag ** 2)
+        phase = torch.atan2(imag, real)
+        return mags, phase
 
 
 class ConviSTFT(nn.Module):
+    # the python cache of the envelopes is not a part of the scripted module
+    __jit_ignored_attributes__ = ['envelopes']
 
-    def __init__(self, win_len, win_inc, fft_len=None, win_type='hamming', feature_type='real', fix=True):
+    def __init__(self, win_len, win_inc, fft_len=None, win_type='hamming', feature_type='real', fix=True,
+                 backend=cfg.stft_backend, cache_size=16):
+        '''
+            backend: 'conv' (conv_transpose1d with the inverse kernel) or 'fft' (torch.fft.irfft and overlap-add)
+            cache_size: number of the normalization envelopes kept (least recently used ones are dropped)
+        '''
         super(ConviSTFT, self).__init__()
         if fft_len == None:
             self.fft_len = np.int(2 ** np.ceil(np.log2(win_len)))
@@ -85,24 +143,46 @@ class ConviSTFT(nn.Module):
         self.stride = win_inc
         self.dim = self.fft_len
         self.register_buffer('window', window)
-        self.register_buffer('enframe', torch.eye(win_len)[:, None, :])
-
-    def forward(self, inputs, phase=None):
+        self.backend = backend
+        if backend == 'fft':
+            alias_basis, alias_weight = init_fft_inverse(win_len, self.fft_len)
+        else:
+            alias_basis, alias_weight = torch.zeros(win_len, 2), torch.zeros(win_len, 2)
+        self.register_buffer('alias_basis', alias_basis, persistent=False)
+        self.register_buffer('alias_weight', alias_weight, persistent=False)
+        # overlap-add of the squared window for each (number of frames, dtype, device)
+        self.envelopes = OrderedDict()
+        self.cache_size = cache_size
+
+    def forward(self, inputs, phase: Optional[torch.Tensor] = None):
         """
         inputs : [B, N+2, T] (complex spec) or [B, N//2+1, T] (mags)
         phase: [B, N//2+1, T] (if not none)
         """
-
+        # always in fp32 (also under autocast): the normalization divides by the small window sums
+        if torch.jit.is_scripting():
+            return self.transform(inputs, phase)
+        with torch.autocast(inputs.device.type, enabled=False):
+            return self.transform(inputs, phase)
+
+    def transform(self, inputs, phase: Optional[torch.Tensor] = None):
+        inputs = inputs.float()
         if phase is not None:
+            phase = phase.float()
             real = inputs * torch.cos(phase)
             imag = inputs * torch.sin(phase)
             inputs = torch.cat([real, imag], 1)
 
-        outputs = F.conv_transpose1d(inputs, self.weight, stride=self.stride)
+        if self.backend == 'fft':
+            outputs = self.fft_istft(inputs)
+        else:
+            outputs = F.conv_transpose1d(inputs, self.weight, stride=self.stride)
 
         # this is from torch-stft: https://github.com/pseeth/torch-stft
-        t = self.window.repeat(1, 1, inputs.size(-1)) ** 2
-        coff = F.conv_transpose1d(t, self.enframe, stride=self.stride)
+        if torch.jit.is_scripting():
+            coff = self.envelope(inputs.size(-1))
+        else:
+            coff = self.cached_envelope(inputs.size(-1))
 
         outputs = outputs / (coff + 1e-8)
 
@@ -111,6 +191,54 @@ class ConviSTFT(nn.Module):
 
         return outputs
 
+    def frame(self, inputs):
+        """
+        [B, N+2] spectrum of one frame -> [B, win_len] windowed frame before the overlap-add (streaming inference),
+        the output of forward is the overlap-add of the frames / the overlap-add of window ** 2
+        """
+        inputs = inputs.float().unsqueeze(-1)
+        if self.backend == 'fft':
+            return self.fft_istft(inputs)[:, 0]
+        return F.conv_transpose1d(inputs, self.weight, stride=self.stride)[:, 0]
+
+    def fft_istft(self, inputs):
+        # the same frames as conv_transpose1d with the pinv kernel (see init_fft_inverse)
+        dim = self.fft_len // 2 + 1
+        spec = torch.complex(inputs[:, :dim], inputs[:, dim:]).transpose(1, 2)  # [B, T, N//2+1]
+        frames = torch.fft.irfft(spec, n=self.fft_len)[..., :self.win_len] * (self.fft_len / 2)
+        edges = torch.stack([inputs[:, 0], inputs[:, dim - 1]], -1)  # [B, T, 2] DC and Nyquist
+        frames = frames + torch.matmul(edges, self.alias_basis.t()) / 2
+        frames = frames - torch.matmul(torch.matmul(frames, self.alias_basis), self.alias_weight.t())
+        frames = frames * (self.window.view(-1) / (self.fft_len / 2))  # [B, T, win_len]
+        return self.overlap_add(frames.transpose(1, 2))
+
+    def overlap_add(self, frames):
+        # [B, win_len, T] -> [B, 1, (T - 1) * stride + win_len]
+        length = (frames.size(-1) - 1) * self.stride + self.win_len
+        outputs = F.fold(frames, [1, length], [1, self.win_len], stride=[1, self.stride])
+        return outputs.view(frames.size(0), 1, length)
+
+    def envelope(self, num_frames: int):
+        # [1, 1, L] overlap-add of the squared window: the normalization of the output
+        frames = (self.window.view(1, -1, 1) ** 2).expand(1, self.win_len, num_frames)
+        return self.overlap_add(frames)
+
+    @torch.jit.unused
+    def cached_envelope(self, num_frames: int):
+        key = (num_frames, self.window.dtype, self.window.device)
+        if key in self.envelopes:
+            self.envelopes.move_to_end(key)
+        else:
+            self.envelopes[key] = self.envelope(num_frames)
+            if len(self.envelopes) > self.cache_size:
+                self.envelopes.popitem(last=False)
+        return self.envelopes[key]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the identity 'enframe' buffer of the old checkpoints is not used anymore
+        state_dict.pop(prefix + 'enframe', None)
+        super(ConviSTFT, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 ############################################################################
 #                             for complex rnn                              #
@@ -139,9 +267,16 @@ class cPReLU(nn.Module):
 
 
 class NavieComplexLSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, projection_dim=None, bidirectional=False, batch_first=False):
+    def __init__(self, input_size, hidden_size, projection_dim=None, bidirectional=False, batch_first=False,
+                 batched=False):
+        '''
+            batched: run real_lstm and imag_lstm once each on [real, imag] concatenated along the batch
+                     instead of twice each (the same parameters and outputs),
+                     faster or slower depending on the layer (python benchmark.py complex_lstm)
+        '''
         super(NavieComplexLSTM, self).__init__()
 
+        self.batched = batched
         self.input_dim = input_size // 2
         self.rnn_units = hidden_size // 2
         self.real_lstm = nn.LSTM(self.input_dim, self.rnn_units, num_layers=1, bidirectional=bidirectional,
@@ -157,31 +292,56 @@ class NavieComplexLSTM(nn.Module):
             self.r_trans = nn.Linear(self.rnn_units * bidirectional, self.projection_dim)
             self.i_trans = nn.Linear(self.rnn_units * bidirectional, self.projection_dim)
         else:
+            # no parameters: the state_dict is the same as before
             self.projection_dim = None
+            self.r_trans = nn.Identity()
+            self.i_trans = nn.Identity()
 
-    def forward(self, inputs):
-        if isinstance(inputs, list):
-            real, imag = inputs
-        elif isinstance(inputs, torch.Tensor):
-            real, imag = torch.chunk(inputs, -1)
-        r2r_out = self.real_lstm(real)[0]
-        r2i_out = self.imag_lstm(real)[0]
-        i2r_out = self.real_lstm(imag)[0]
-        i2i_out = self.imag_lstm(imag)[0]
+    def forward(self, real, imag) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        real, imag: [T, B, input_size // 2]
+        returns: real, imag [T, B, projection_dim // 2 (or hidden_size // 2)]
+        """
+        if self.batched:
+            inputs = torch.cat([real, imag], 1)  # [T, 2B, input_size // 2]
+            r2r_out, i2r_out = torch.chunk(self.real_lstm(inputs)[0], 2, 1)
+            r2i_out, i2i_out = torch.chunk(self.imag_lstm(inputs)[0], 2, 1)
+        else:
+            r2r_out = self.real_lstm(real)[0]
+            r2i_out = self.imag_lstm(real)[0]
+            i2r_out = self.real_lstm(imag)[0]
+            i2i_out = self.imag_lstm(imag)[0]
         real_out = r2r_out - i2i_out
         imag_out = i2r_out + r2i_out
-        if self.projection_dim is not None:
-            real_out = self.r_trans(real_out)
-            imag_out = self.i_trans(imag_out)
-        # print(real_out.shape,imag_out.shape)
-        return [real_out, imag_out]
+        real_out = self.r_trans(real_out)
+        imag_out = self.i_trans(imag_out)
+        return real_out, imag_out
+
+    def step(self, real, imag, state: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]] = None):
+        """
+        forward with the LSTM states (streaming inference), always on the [real, imag] batch
+        state: (h, c) of real_lstm and (h, c) of imag_lstm, None: zeros
+        returns: real, imag, state
+        """
+        inputs = torch.cat([real, imag], 1)
+        if state is None:
+            real_out, (real_h, real_c) = self.real_lstm(inputs)
+            imag_out, (imag_h, imag_c) = self.imag_lstm(inputs)
+        else:
+            real_out, (real_h, real_c) = self.real_lstm(inputs, (state[0], state[1]))
+            imag_out, (imag_h, imag_c) = self.imag_lstm(inputs, (state[2], state[3]))
+        r2r_out, i2r_out = torch.chunk(real_out, 2, 1)
+        r2i_out, i2i_out = torch.chunk(imag_out, 2, 1)
+        real_out = self.r_trans(r2r_out - i2i_out)
+        imag_out = self.i_trans(i2r_out + r2i_out)
+        return real_out, imag_out, (real_h, real_c, imag_h, imag_c)
 
     def flatten_parameters(self):
         self.imag_lstm.flatten_parameters()
         self.real_lstm.flatten_parameters()
 
 
-def complex_cat(inputs, axis):
+def complex_cat(inputs: List[torch.Tensor], axis: int):
     real, imag = [], []
     for idx, data in enumerate(inputs):
         r, i = torch.chunk(data, 2, axis)
@@ -209,6 +369,7 @@ class ComplexConv2d(nn.Module):
             groups=1,
             causal=True,
             complex_axis=1,
+            fused=True,
     ):
         '''
             in_channels: real+imag
@@ -217,6 +378,8 @@ class ComplexConv2d(nn.Module):
             padding : input [B,C,D,T] padding in [D,T]
             causal: if causal, will padding time dimension's left side,
                     otherwise both
+            fused: one convolution with the block weight [[Wr, -Wi], [Wi, Wr]] instead of four
+                   (complex_axis=1 and groups=1 only)
 
         '''
         super(ComplexConv2d, self).__init__()
@@ -229,6 +392,7 @@ class ComplexConv2d(nn.Module):
         self.groups = groups
         self.dilation = dilation
         self.complex_axis = complex_axis
+        self.fused = fused and complex_axis == 1 and groups == 1
 
         self.real_conv = nn.Conv2d(self.in_channels, self.out_channels, kernel_size, self.stride,
                                    padding=[self.padding[0], 0], dilation=self.dilation, groups=self.groups)
@@ -245,6 +409,14 @@ class ComplexConv2d(nn.Module):
             inputs = F.pad(inputs, [self.padding[1], 0, 0, 0])  # # [width left, width right, height left, height right]
         else:
             inputs = F.pad(inputs, [self.padding[1], self.padding[1], 0, 0])
+        return self.convolve(inputs)
+
+    def convolve(self, inputs):
+        # the convolution of the time-padded inputs (the streaming inference gives the past frames instead)
+        if self.fused:
+            weight, bias = self.fused_weight()
+            return F.conv2d(inputs, weight, bias, self.real_conv.stride, self.real_conv.padding,
+                            self.real_conv.dilation)
 
         if self.complex_axis == 0:
             real = self.real_conv(inputs)
@@ -253,8 +425,7 @@ class ComplexConv2d(nn.Module):
             real2imag, imag2imag = torch.chunk(imag, 2, self.complex_axis)
 
         else:
-            if isinstance(inputs, torch.Tensor):
-                real, imag = torch.chunk(inputs, 2, self.complex_axis)
+            real, imag = torch.chunk(inputs, 2, self.complex_axis)
 
             real2real = self.real_conv(real, )
             imag2imag = self.imag_conv(imag, )
@@ -268,6 +439,17 @@ class ComplexConv2d(nn.Module):
 
         return out
 
+    def fused_weight(self):
+        # [real; imag] out = [[Wr, -Wi], [Wi, Wr]] * [real; imag] in
+        # built from real_conv and imag_conv on every call, so the parameters (and checkpoints) stay the same
+        real_weight, imag_weight = self.real_conv.weight, self.imag_conv.weight
+        weight = torch.cat([torch.cat([real_weight, -imag_weight], 1),
+                            torch.cat([imag_weight, real_weight], 1)], 0)
+        real_bias, imag_bias = self.real_conv.bias, self.imag_conv.bias
+        assert real_bias is not None and imag_bias is not None
+        bias = torch.cat([real_bias - imag_bias, real_bias + imag_bias])
+        return weight, bias
+
 
 class ComplexConvTranspose2d(nn.Module):
 
@@ -281,11 +463,14 @@ class ComplexConvTranspose2d(nn.Module):
             output_padding=(0, 0),
             causal=False,
             complex_axis=1,
-            groups=1
+            groups=1,
+            fused=False,
     ):
         '''
             in_channels: real+imag
             out_channels: real+imag
+            fused: one transposed convolution with the block weight (see ComplexConv2d),
+                off by default: not faster for every layer of the decoder (python benchmark.py complex_conv)
         '''
         super(ComplexConvTranspose2d, self).__init__()
         self.in_channels = in_channels // 2
@@ -302,6 +487,7 @@ class ComplexConvTranspose2d(nn.Module):
                                             padding=self.padding, output_padding=output_padding, groups=self.groups)
 
         self.complex_axis = complex_axis
+        self.fused = fused and complex_axis == 1 and groups == 1
 
         nn.init.normal_(self.real_conv.weight.data, std=0.05)
         nn.init.normal_(self.imag_conv.weight.data, std=0.05)
@@ -309,12 +495,11 @@ class ComplexConvTranspose2d(nn.Module):
         nn.init.constant_(self.imag_conv.bias, 0.)
 
     def forward(self, inputs):
+        if self.fused:
+            weight, bias = self.fused_weight()
+            return F.conv_transpose2d(inputs, weight, bias, self.real_conv.stride, self.real_conv.padding,
+                                      self.real_conv.output_padding, 1, self.real_conv.dilation)
 
-        if isinstance(inputs, torch.Tensor):
-            real, imag = torch.chunk(inputs, 2, self.complex_axis)
-        elif isinstance(inputs, tuple) or isinstance(inputs, list):
-            real = inputs[0]
-            imag = inputs[1]
         if self.complex_axis == 0:
             real = self.real_conv(inputs)
             imag = self.imag_conv(inputs)
@@ -322,8 +507,7 @@ class ComplexConvTranspose2d(nn.Module):
             real2imag, imag2imag = torch.chunk(imag, 2, self.complex_axis)
 
         else:
-            if isinstance(inputs, torch.Tensor):
-                real, imag = torch.chunk(inputs, 2, self.complex_axis)
+            real, imag = torch.chunk(inputs, 2, self.complex_axis)
 
             real2real = self.real_conv(real, )
             imag2imag = self.imag_conv(imag, )
@@ -337,6 +521,16 @@ class ComplexConvTranspose2d(nn.Module):
 
         return out
 
+    def fused_weight(self):
+        # the weight of ConvTranspose2d is [in, out, kH, kW]: [[Wr, Wi], [-Wi, Wr]]
+        real_weight, imag_weight = self.real_conv.weight, self.imag_conv.weight
+        weight = torch.cat([torch.cat([real_weight, imag_weight], 1),
+                            torch.cat([-imag_weight, real_weight], 1)], 0)
+        real_bias, imag_bias = self.real_conv.bias, self.imag_conv.bias
+        assert real_bias is not None and imag_bias is not None
+        bias = torch.cat([real_bias - imag_bias, real_bias + imag_bias])
+        return weight, bias
+
 
 class RealConv2d(nn.Module):
 
@@ -607,7 +801,7 @@ class ComplexBatchNorm(torch.nn.Module):
                'track_running_stats={track_running_stats}'.format(**self.__dict__)
 
 
-def complex_cat(inputs, axis):
+def complex_cat(inputs: List[torch.Tensor], axis: int):
     real, imag = [], []
     for idx, data in enumerate(inputs):
         r, i = torch.chunk(data, 2, axis)
@@ -718,6 +912,7 @@ def compress_cIRM(mask, K=10, C=0.1):
 
 
 def decompress_cIRM(mask, K=10, limit=9.9):
+    mask = mask.float()  # the log in fp32 (also under autocast)
     mask = limit * (mask >= limit) - limit * (mask <= -limit) + mask * (torch.abs(mask) < limit)
     mask = -K * torch.log((K - mask) / (K + mask))
     return mask
@@ -773,6 +968,8 @@ class SequenceModel(nn.Module):
                 self.activate_function = nn.ReLU6()
             else:
                 raise NotImplementedError(f"Not implemented activation function {self.activate_function}")
+        else:
+            self.activate_function = nn.Identity()
 
         self.output_activate_function = output_activate_function
 
@@ -784,13 +981,13 @@ class SequenceModel(nn.Module):
             [B, F, T]
         """
         assert x.dim() == 3
-        self.sequence_model.flatten_parameters()
+        if not torch.jit.is_scripting():
+            self.sequence_model.flatten_parameters()
 
         x = x.permute(0, 2, 1).contiguous()  # [B, F, T] => [B, T, F]
         o, _ = self.sequence_model(x)
         o = self.fc_output_layer(o)
-        if self.output_activate_function:
-            o = self.activate_function(o)
+        o = self.activate_function(o)  # (nn.Identity without output_activate_function)
         o = o.permute(0, 2, 1).contiguous()  # [B, T, F] => [B, F, T]
         return o
     
@@ -798,14 +995,115 @@ class SequenceModel(nn.Module):
 EPSILON = np.finfo(np.float32).eps
 
 
+def exponential_smoothing(input, alpha, initial, block_size=64):
+    """
+    y_t = alpha * y_{t-1} + input_t (y_-1 = initial) without a loop over the frames:
+    a lower triangular matmul in each block of block_size frames (zero initial state),
+    and the same scan over the states at the end of the blocks (with alpha ** block_size)
+
+    Args:
+        input: [B, T]
+        alpha: float
+        initial: [B]
+
+    Returns:
+        [B, T]
+    """
+    batch_size, num_frames = input.size()
+    steps = torch.arange(min(num_frames, block_size), dtype=input.dtype, device=input.device)
+    decay = torch.tril(alpha ** (steps[:, None] - steps[None, :]).clamp(min=0))  # [K, K]
+    carry = alpha ** (steps + 1)  # [K] weight of the state before the block
+    if num_frames <= block_size:
+        return torch.matmul(input, decay.t()) + initial[:, None] * carry
+
+    num_blocks = -(-num_frames // block_size)
+    blocks = F.pad(input, [0, num_blocks * block_size - num_frames]).reshape(batch_size, num_blocks, block_size)
+    local = torch.matmul(blocks, decay.t())  # [B, N, K]
+    ends = exponential_smoothing(local[..., -1], alpha ** block_size, initial, block_size)  # [B, N]
+    starts = torch.cat([initial[:, None], ends[:, :-1]], dim=1)
+    output = local + starts[..., None] * carry
+    return output.reshape(batch_size, -1)[:, :num_frames]
+
+
+def forgetting_mean(input, sample_length_in_training, steady_input=None):
+    """
+    mu_t = a_t * mu_{t-1} + (1 - a_t) * x_t, mu_-1 = 0, a_t = min((t - 1) / (t + 1), alpha) of the forgetting norms
+        t < L (warm-up): t(t+1) mu_t = (t-1)t mu_{t-1} + 2t x_t, so mu_0 = 2 x_0, mu_t = 2 cumsum(s x_s) / (t(t+1))
+        t >= L: a_t = alpha, exponential_smoothing
+
+    Args:
+        input: [B, T], x_t of the warm-up (and after it, if steady_input is None)
+        sample_length_in_training: L
+        steady_input: [B, T], x_t after the warm-up
+
+    Returns:
+        [B, T]
+    """
+    if steady_input is None:
+        steady_input = input
+    num_frames = input.size(-1)
+    alpha = (sample_length_in_training - 1) / (sample_length_in_training + 1)
+
+    warm_up = input[:, :sample_length_in_training]
+    steps = torch.arange(warm_up.size(-1), dtype=input.dtype, device=input.device)
+    mu = 2 * torch.cumsum(warm_up * steps, dim=-1) / (steps * (steps + 1)).clamp(min=1)
+    mu = torch.cat([2 * warm_up[:, :1], mu[:, 1:]], dim=-1)
+    if num_frames <= sample_length_in_training:
+        return mu
+
+    steady = exponential_smoothing((1 - alpha) * steady_input[:, sample_length_in_training:], alpha, mu[:, -1])
+    return torch.cat([mu, steady], dim=-1)
+
+
+def forgetting_mean_loop(input, sample_length_in_training, steady_input=None):
+    """forgetting_mean with the loop over the frames of the old forgetting norms (the reference, see benchmark.py)"""
+    if steady_input is None:
+        steady_input = input
+    batch_size = input.size(0)
+    alpha = (sample_length_in_training - 1) / (sample_length_in_training + 1)
+
+    mu = 0
+    mu_list = []
+    for idx in range(input.shape[-1]):
+        if idx < sample_length_in_training:
+            alp = torch.min(torch.tensor([(idx - 1) / (idx + 1), alpha]))
+            mu = alp * mu + (1 - alp) * input[:, idx].reshape(batch_size, 1)  # [B, 1]
+        else:
+            mu = alpha * mu + (1 - alpha) * steady_input[:, idx].reshape(batch_size, 1)
+        mu_list.append(mu)
+    return torch.cat(mu_list, dim=-1)  # [B, T]
+
+
+def masked_var_mean(input, mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Utterance-level var (biased), mean and number of the entries, only on the valid frames (the offline norms)
+
+    Args:
+        input: [B, X, Y, T]
+        mask: [B, 1, 1, T] 1 for the valid frames, 0 for the padding (None: all the frames)
+
+    Returns:
+        var, mu, count [B, 1, 1, 1]
+    """
+    if mask is None:
+        var, mu = torch.var_mean(input, dim=(1, 2, 3), unbiased=False, keepdim=True)
+        return var, mu, torch.full_like(mu, input[0].numel())
+    count = torch.sum(mask, dim=(1, 2, 3), keepdim=True) * (input.size(1) * input.size(2))
+    mu = torch.sum(input * mask, dim=(1, 2, 3), keepdim=True) / count
+    var = torch.sum(((input - mu) * mask) ** 2, dim=(1, 2, 3), keepdim=True) / count
+    return var, mu, count
+
+
 class BaseModel(nn.Module):
     def __init__(self):
         super(BaseModel, self).__init__()
 
     @staticmethod
-    def unfold(input, num_neighbor):
+    def unfold(input: torch.Tensor, num_neighbor: int):
         """
         Along with the frequency dim, split overlapped sub band units from spectrogram.
+        The units are a strided view of the padded spectrogram (no copy of each unit):
+        use them as they are, or slice them before anything that makes them contiguous.
 
         Args:
             input: [B, C, F, T]
@@ -814,7 +1112,7 @@ class BaseModel(nn.Module):
         Returns:
             [B, N, C, F_s, T], F, e.g. [2, 161, 1, 19, 200]
         """
-        assert input.dim() == 4, f"The dim of input is {input.dim()}. It should be four dim."
+        assert input.dim() == 4, "The dim of input should be four dim."
         batch_size, num_channels, num_freqs, num_frames = input.size()
 
         if num_neighbor < 1:
@@ -826,56 +1124,47 @@ class BaseModel(nn.Module):
 
         # Pad to the top and bottom
         output = F.pad(output, [0, 0, num_neighbor, num_neighbor], mode="reflect")
+        output = output.reshape(batch_size, num_channels, num_freqs + num_neighbor * 2, num_frames)
 
-        output = F.unfold(output, (sub_band_unit_size, num_frames))
-        assert output.shape[-1] == num_freqs, f"n_freqs != N (sub_band), {num_freqs} != {output.shape[-1]}"
+        # [B, C, N, T, F_s] sliding window along the frequency
+        output = output.unfold(2, sub_band_unit_size, 1)
+        assert output.shape[2] == num_freqs, "n_freqs != N (sub_band)"
 
-        # Split the dim of the unfolded feature
-        output = output.reshape(batch_size, num_channels, sub_band_unit_size, num_frames, num_freqs)
-        output = output.permute(0, 4, 1, 2, 3).contiguous()
-
-        return output
+        return output.permute(0, 2, 1, 4, 3)
 
     @staticmethod
-    def _reduce_complexity_separately(sub_band_input, full_band_output, device):
+    def _reduce_complexity_separately(batch_size, num_freqs, ratio, device):
         """
+        Frequency subsampling in training: random freqs of each sample for the sub-band model.
+        Only these freqs go through the sub-band model (see FullSubNet.forward), and the loss is computed on them.
+        (It was thirds of the batch with every third freq; now any ratio, and all the freqs can be selected.)
 
         Args:
-            sub_band_input: [60, 257, 1, 33, 200]
-            full_band_output: [60, 257, 1, 3, 200]
+            batch_size:
+            num_freqs:
+            ratio: rate of the selected freqs, e.g. 1/3
             device:
 
-        Notes:
-            1. 255 and 256 freq not able to be trained
-            2. batch size 
-
         Returns:
-            [60, 85, 1, 36, 200]
+            [B, K] sorted freq indices of each sample, K = round(num_freqs * ratio)
         """
-        batch_size = full_band_output.shape[0]
-        n_freqs = full_band_output.shape[1]
-        sub_batch_size = batch_size // 3
-        final_selected = []
-
-        for idx in range(3):
-            # [0, 60) => [0, 20)
-            sub_batch_indices = torch.arange(idx * sub_batch_size, (idx + 1) * sub_batch_size, device=device)
-            full_band_output_sub_batch = torch.index_select(full_band_output, dim=0, index=sub_batch_indices)
-            sub_band_output_sub_batch = torch.index_select(sub_band_input, dim=0, index=sub_batch_indices)
-
-            # Avoid to use padded value (first freq and last freq)
-            # i = 0, (1, 256, 3) = [1, 4, ..., 253]
-            # i = 1, (2, 256, 3) = [2, 5, ..., 254]
-            # i = 2, (3, 256, 3) = [3, 6, ..., 255]
-            freq_indices = torch.arange(idx + 1, n_freqs - 1, step=3, device=device)
-            full_band_output_sub_batch = torch.index_select(full_band_output_sub_batch, dim=1, index=freq_indices)
-            sub_band_output_sub_batch = torch.index_select(sub_band_output_sub_batch, dim=1, index=freq_indices)
-
-            # ([30, 85, 1, 33 200], [30, 85, 1, 3, 200]) => [30, 85, 1, 36, 200]
+        num_selected = max(1, int(round(num_freqs * ratio)))
+        scores = torch.rand(batch_size, num_freqs, device=device)
+        freqs = torch.topk(scores, num_selected, dim=1).indices
+        return torch.sort(freqs, dim=1).values
 
-            final_selected.append(torch.cat([sub_band_output_sub_batch, full_band_output_sub_batch], dim=-2))
+    @staticmethod
+    def select_freqs(input, freqs):
+        """
+        Args:
+            input: [B, F, ...]
+            freqs: [B, K] freq indices of each sample
 
-        return torch.cat(final_selected, dim=0)
+        Returns:
+            [B, K, ...]
+        """
+        index = freqs.reshape(freqs.shape + (1,) * (input.dim() - 2)).expand((-1, -1) + input.shape[2:])
+        return torch.gather(input, 1, index)
 
     @staticmethod
     def sband_forgetting_norm(input, train_sample_length):
@@ -889,27 +1178,12 @@ class BaseModel(nn.Module):
         """
         assert input.ndim == 3
         batch_size, n_freqs, n_frames = input.size()
-
         eps = 1e-10
-        alpha = (train_sample_length - 1) / (train_sample_length + 1)
-        mu = 0
-        mu_list = []
-
-        for idx in range(input.shape[-1]):
-            if idx < train_sample_length:
-                alp = torch.min(torch.tensor([(idx - 1) / (idx + 1), alpha]))
-                mu = alp * mu + (1 - alp) * torch.mean(input[:, :, idx], dim=1).reshape(batch_size, 1)  # [B, 1]
-            else:
-                mu = alpha * mu + (1 - alpha) * input[:, (n_freqs // 2 - 1), idx].reshape(batch_size, 1)
-
-            mu_list.append(mu)
 
-            # print("input", input[:, :, idx].min(), input[:, :, idx].max(), input[:, :, idx].mean())
-            # print(f"alp {idx}: ", alp)
-            # print(f"mu {idx}: {mu[128, 0]}")
-
-        mu = torch.stack(mu_list, dim=-1)  # [B, 1, T]
-        input = input / (mu + eps)
+        # the mean of all the freqs in the warm-up, then the center freq
+        mu = forgetting_mean(torch.mean(input, dim=1), train_sample_length,
+                             steady_input=input[:, n_freqs // 2 - 1, :])  # [B, T]
+        input = input / (mu.reshape(batch_size, 1, n_frames) + eps)
         return input
 
     @staticmethod
@@ -925,26 +1199,9 @@ class BaseModel(nn.Module):
         assert input.ndim == 3
         batch_size, n_freqs, n_frames = input.size()
         eps = 1e-10
-        mu = 0
-        alpha = (sample_length_in_training - 1) / (sample_length_in_training + 1)
-
-        mu_list = []
-        for idx in range(input.shape[-1]):
-            if idx < sample_length_in_training:
-                alp = torch.min(torch.tensor([(idx - 1) / (idx + 1), alpha]))
-                mu = alp * mu + (1 - alp) * torch.mean(input[:, :, idx], dim=1).reshape(batch_size, 1)  # [B, 1]
-            else:
-                current_frame_mu = torch.mean(input[:, :, idx], dim=1).reshape(batch_size, 1)  # [B, 1]
-                mu = alpha * mu + (1 - alpha) * current_frame_mu
 
-            mu_list.append(mu)
-
-            # print("input", input[:, :, idx].min(), input[:, :, idx].max(), input[:, :, idx].mean())
-            # print(f"alp {idx}: ", alp)
-            # print(f"mu {idx}: {mu[128, 0]}")
-
-        mu = torch.stack(mu_list, dim=-1)  # [B, 1, T]
-        input = input / (mu + eps)
+        mu = forgetting_mean(torch.mean(input, dim=1), sample_length_in_training)  # [B, T]
+        input = input / (mu.reshape(batch_size, 1, n_frames) + eps)
         return input
 
     @staticmethod
@@ -963,17 +1220,10 @@ class BaseModel(nn.Module):
         batch_size, n_freqs, n_frames = input.size()
         eps = 1e-10
 
-        mu = 0
-        alpha = (sample_length_in_training - 1) / (sample_length_in_training + 1)
-        mu_list = []
-        for idx in range(input.shape[-1]):
-            if idx < sample_length_in_training:
-                alp = torch.min(torch.tensor([(idx - 1) / (idx + 1), alpha]))
-                mu = alp * mu + (1 - alp) * torch.mean(input[:, :, idx], dim=1).reshape(batch_size, 1)  # [B, 1]
-                mu_list.append(mu)
-            else:
-                break
-        initial_mu = torch.stack(mu_list, dim=-1)  # [B, 1, T]
+        # the warm-up of forgetting_norm
+        initial_mu = forgetting_mean(torch.mean(input[:, :, :sample_length_in_training], dim=1),
+                                     sample_length_in_training)
+        initial_mu = initial_mu.reshape(batch_size, 1, -1)  # [B, 1, T]
 
         step_sum = torch.sum(input, dim=1)  # [B, T]
         cumulative_sum = torch.cumsum(step_sum, dim=-1)  # [B, T]
@@ -994,24 +1244,28 @@ class BaseModel(nn.Module):
         return input / (cum_mean + eps)
 
     @staticmethod
-    def offline_laplace_norm(input):
+    def offline_laplace_norm(input, mask: Optional[torch.Tensor] = None):
         """
 
         Args:
             input: [B, C, F, T]
+            mask: [B, 1, 1, T] valid frames (None: all), see masked_var_mean
 
         Returns:
             [B, C, F, T]
         """
         # utterance-level mu
-        mu = torch.mean(input, dim=(1, 2, 3), keepdim=True)
+        if mask is None:
+            mu = torch.mean(input, dim=(1, 2, 3), keepdim=True)
+        else:
+            mu = masked_var_mean(input, mask)[1]
 
         normed = input / (mu + 1e-5)
 
         return normed
 
     @staticmethod
-    def cumulative_laplace_norm(input):
+    def cumulative_laplace_norm(input, eps: float = float(EPSILON)):
         """
 
         Args:
@@ -1039,29 +1293,34 @@ class BaseModel(nn.Module):
         cumulative_mean = cumulative_sum / entry_count  # B, T
         cumulative_mean = cumulative_mean.reshape(batch_size * num_channels, 1, num_frames)
 
-        normed = input / (cumulative_mean + EPSILON)
+        normed = input / (cumulative_mean + eps)
 
         return normed.reshape(batch_size, num_channels, num_freqs, num_frames)
 
     @staticmethod
-    def offline_gaussian_norm(input):
+    def offline_gaussian_norm(input, mask: Optional[torch.Tensor] = None):
         """
         Zero-Norm
         Args:
             input: [B, C, F, T]
+            mask: [B, 1, 1, T] valid frames (None: all), see masked_var_mean
 
         Returns:
             [B, C, F, T]
         """
-        mu = torch.mean(input, dim=(1, 2, 3), keepdim=True)
-        std = torch.std(input, dim=(1, 2, 3), keepdim=True)
+        if mask is None:
+            mu = torch.mean(input, dim=(1, 2, 3), keepdim=True)
+            std = torch.std(input, dim=(1, 2, 3), keepdim=True)
+        else:
+            var, mu, count = masked_var_mean(input, mask)
+            std = torch.sqrt(var * count / (count - 1))
 
         normed = (input - mu) / (std + 1e-5)
 
         return normed
 
     @staticmethod
-    def cumulative_layer_norm(input):
+    def cumulative_layer_norm(input, eps: float = float(EPSILON)):
         """
         Online zero-norm
 
@@ -1094,7 +1353,7 @@ class BaseModel(nn.Module):
         cumulative_var = (
                                  cumulative_pow_sum - 2 * cumulative_mean * cumulative_sum) / entry_count + cumulative_mean.pow(
             2)  # [B, T]
-        cumulative_std = torch.sqrt(cumulative_var + EPSILON)  # [B, T]
+        cumulative_std = torch.sqrt(cumulative_var + eps)  # [B, T]
 
         cumulative_mean = cumulative_mean.reshape(batch_size * num_channels, 1, num_frames)
         cumulative_std = cumulative_std.reshape(batch_size * num_channels, 1, num_frames)
@@ -1103,6 +1362,58 @@ class BaseModel(nn.Module):
 
         return normed.reshape(batch_size, num_channels, num_freqs, num_frames)
 
+    def sub_band_statistics(self, noisy_units, fb_units,
+                            mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Utterance-level mean and std (offline norms) of torch.cat([noisy_units, fb_units], dim=2),
+        reduced on the (strided) units without building the concatenation
+
+        Args:
+            noisy_units: [B, F, C_s, T]
+            fb_units: [B, F, C_f, T]
+            mask: [B, 1, 1, T] valid frames (None: all), see masked_var_mean
+
+        Returns:
+            mu, std [B, 1, 1, 1]
+        """
+        noisy_var, noisy_mu, noisy_count = masked_var_mean(noisy_units, mask)
+        fb_var, fb_mu, fb_count = masked_var_mean(fb_units, mask)
+
+        mu = (noisy_mu * noisy_count + fb_mu * fb_count) / (noisy_count + fb_count)
+        squares = noisy_count * (noisy_var + (noisy_mu - mu) ** 2) + fb_count * (fb_var + (fb_mu - mu) ** 2)
+        std = torch.sqrt(squares / (noisy_count + fb_count - 1))
+        return mu, std
+
+    def sub_band_norm(self, input, mu, std):
+        """
+        self.norm of the sub-band input [B, F, C, T] for a part of the freqs:
+        the offline norms use the statistics of all the freqs (sub_band_statistics),
+        the cumulative norms normalize each sub-band unit by itself
+        """
+        if self.norm_type == "offline_laplace_norm":
+            return input / (mu + 1e-5)
+        elif self.norm_type == "offline_gaussian_norm":
+            return (input - mu) / (std + 1e-5)
+        else:
+            return self.norm(input)
+
+    def norm(self, input, mask: Optional[torch.Tensor] = None):
+        """
+        the normalization of self.norm_type (set in __init__ of the model), scriptable
+        mask: [B, 1, 1, T] valid frames for the offline norms (the cumulative norms are causal:
+              the padding at the end does not change the valid frames)
+        """
+        if self.norm_type == "offline_laplace_norm":
+            return self.offline_laplace_norm(input, mask)
+        elif self.norm_type == "cumulative_laplace_norm":
+            return self.cumulative_laplace_norm(input)
+        elif self.norm_type == "offline_gaussian_norm":
+            return self.offline_gaussian_norm(input, mask)
+        elif self.norm_type == "cumulative_layer_norm":
+            return self.cumulative_layer_norm(input)
+        else:
+            raise NotImplementedError("You must set up a type of Norm.")
+
     def norm_wrapper(self, norm_type: str):
         if norm_type == "offline_laplace_norm":
             norm = self.offline_laplace_norm
@@ -1361,7 +1672,8 @@ class Bar(object):
         self.dataloader = dataloader
         self.iterator = iter(dataloader)
         self.dataset = dataloader.dataset
-        self.batch_size = dataloader.batch_size
+        # with a batch_sampler (e.g. BucketBatchSampler), batch_size of the dataloader is None
+        self.batch_size = dataloader.batch_size or dataloader.batch_sampler.batch_size
         self._idx = 0
         self._batch_idx = 0
         self._time = []
@@ -6,12 +6,9 @@ import numpy as np
 import config as cfg
 from models import DCCRN, CRN, FullSubNet  # you can import 'DCCRN' or 'CRN' or 'FullSubNet'
 from write_on_tensorboard import Writer
-from dataloader import create_dataloader
-from trainer import model_train, model_validate, \
-    model_perceptual_train, model_perceptual_validate, \
-    dccrn_direct_train, dccrn_direct_validate, \
-    crn_direct_train, crn_direct_validate, \
-    fullsubnet_train, fullsubnet_validate
+from dataloader import create_dataloader, set_epoch
+from tools_for_distributed import init_distributed, wrap_model, is_main_process, barrier
+from trainer import train, validate, create_step, compile_model, scaler
     
 
 ###############################################################################
@@ -45,8 +42,9 @@ def calculate_total_params(our_model):
 ###############################################################################
 #         Parameter Initialization and Setting for model training             #
 ###############################################################################
-# Set device
-DEVICE = torch.device(cfg.DEVICE)
+# Set device (distributed: join the process group if launched by torchrun, see tools_for_distributed.py)
+DEVICE = init_distributed()
+main_process = is_main_process()  # only rank 0 saves the checkpoints and writes the logs
 
 # Set model
 if cfg.model == 'DCCRN':
@@ -59,22 +57,10 @@ elif cfg.model == 'FullSubNet':
 optimizer = torch.optim.Adam(model.parameters(), lr=cfg.learning_rate)
 total_params = calculate_total_params(model)
 
-# Set trainer and estimator
-if cfg.perceptual is not False:
-    trainer = model_perceptual_train
-    estimator = model_perceptual_validate
-elif cfg.model == 'FullSubNet':
-    trainer = fullsubnet_train
-    estimator = fullsubnet_validate
-elif cfg.masking_mode == 'Direct(None make)' and cfg.model == 'DCCRN':
-    trainer = dccrn_direct_train
-    estimator = dccrn_direct_validate
-elif cfg.masking_mode == 'Direct(None make)' and cfg.model == 'CRN':
-    trainer = crn_direct_train
-    estimator = crn_direct_validate
-else:
-    trainer = model_train
-    estimator = model_validate
+# Set the step of the trainer (forward and loss of the model)
+step = create_step()
+# the (distributed, compiled) model to run, it shares the parameters with 'model'
+train_model = compile_model(wrap_model(model, DEVICE))
 
 ###############################################################################
 #                        Confirm model information                            #
@@ -105,9 +91,11 @@ if cfg.chkpt_model is not None:  # Load the checkpoint
     dir_to_save = cfg.job_dir + cfg.chkpt_model
     dir_to_logs = cfg.logs_dir + cfg.chkpt_model
 
-    checkpoint = torch.load(cfg.chkpt_path)
+    checkpoint = torch.load(cfg.chkpt_path, map_location=DEVICE)
     model.load_state_dict(checkpoint['model'])
     optimizer.load_state_dict(checkpoint['optimizer'])
+    if checkpoint.get('scaler'):  # empty if saved without the float16 scaler
+        scaler.load_state_dict(checkpoint['scaler'])
     epoch_start_idx = checkpoint['epoch'] + 1
     mse_vali_total = np.load(str(dir_to_save + '/mse_vali_total.npy'))
     # if the loaded length is shorter than I expected, extend the length
@@ -118,9 +106,9 @@ else:  # First learning
     print('Starting new training run...')
     
     # make the file directory to save the models
-    if not os.path.exists(cfg.job_dir):
+    if main_process and not os.path.exists(cfg.job_dir):
         os.mkdir(cfg.job_dir)
-    if not os.path.exists(cfg.logs_dir):
+    if main_process and not os.path.exists(cfg.logs_dir):
         os.mkdir(cfg.logs_dir)
         
     epoch_start_idx = 1
@@ -133,13 +121,16 @@ else:  # First learning
                   + '_%s' % cfg.model + '_%s' % cfg.loss
 
 # make the file directory
-if not os.path.exists(dir_to_save):
+if main_process and not os.path.exists(dir_to_save):
     os.mkdir(dir_to_save)
     os.mkdir(dir_to_logs)
+barrier()  # the other processes write their scores in dir_to_save
 
 # logging
 log_fname = str(dir_to_save + '/log.txt')
-if not os.path.exists(log_fname):
+if not main_process:
+    fp = open(os.devnull, 'w')
+elif not os.path.exists(log_fname):
     fp = open(log_fname, 'w')
     write_status_to_log_file(fp, total_params)
 else:
@@ -151,89 +142,64 @@ else:
 ###############################################################################
 ###############################################################################
 # Writer initialize
-writer = Writer(dir_to_logs)
+writer = Writer(dir_to_logs) if main_process else None
 
 ###############################################################################
 #                                    Train                                    #
 ###############################################################################
-if cfg.perceptual is not False:  # train with perceptual loss function
-    for epoch in range(epoch_start_idx, cfg.max_epochs + 1):
-        start_time = time.time()
-        # Training
-        train_loss, train_main_loss, train_perceptual_loss = trainer(model, optimizer, train_loader, DEVICE)
+for epoch in range(epoch_start_idx, cfg.max_epochs + 1):
+    start_time = time.time()
+    # new shuffling and mixtures for every epoch
+    set_epoch(train_loader, epoch)
+    # Training
+    train_loss, train_sub_losses = train(train_model, optimizer, train_loader, DEVICE, step)
 
-        # save checkpoint file to resume training
-        save_path = str(dir_to_save + '/' + ('chkpt_%d.pt' % epoch))
+    # save checkpoint file to resume training
+    save_path = str(dir_to_save + '/' + ('chkpt_%d.pt' % epoch))
+    if main_process:
         torch.save({
             'model': model.state_dict(),
             'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
             'epoch': epoch
         }, save_path)
 
-        # Validation
-        vali_loss, validation_main_loss, validation_perceptual_loss, vali_pesq, vali_stoi = \
-            estimator(model, validation_loader, writer, dir_to_save, epoch, DEVICE)
-        # write the loss on tensorboard
-        writer.log_loss(train_loss, vali_loss, epoch)
-        writer.log_score(vali_pesq, vali_stoi, epoch)
-        writer.log_sub_loss(train_main_loss, train_perceptual_loss,
-                            validation_main_loss, validation_perceptual_loss, epoch)
-
-        print('Epoch [{}] | T {:.6f} | V {:.6} '
-              .format(epoch, train_loss, vali_loss))
-        print('          | T {:.6f} {:.6f} | V {:.6} {:.6f} takes {:.2f} seconds\n'
-              .format(epoch, train_main_loss, train_perceptual_loss, validation_main_loss, validation_perceptual_loss,
-                      time.time() - start_time))
-        print('          | V PESQ: {:.6f} | STOI: {:.6f} '.format(vali_pesq, vali_stoi))
-        # log file save
-        fp.write('Epoch [{}] | T {:.6f} | V {:.6}\n'
-                 .format(epoch, train_loss, vali_loss))
-        fp.write('          | T {:.6f} {:.6f} | V {:.6} {:.6f} takes {:.2f} seconds\n'
-                 .format(epoch, train_main_loss, train_perceptual_loss,
-                         validation_main_loss, validation_perceptual_loss, time.time() - start_time))
-        fp.write('          | V PESQ: {:.6f} | STOI: {:.6f} \n'.format(vali_pesq, vali_stoi))
-
-        mse_vali_total[epoch - 1] = vali_loss
-        np.save(str(dir_to_save + '/mse_vali_total.npy'), mse_vali_total)
-else:
-    for epoch in range(epoch_start_idx, cfg.max_epochs + 1):
-        start_time = time.time()
-        # Training
-        train_loss = trainer(model, optimizer, train_loader, DEVICE)
-
-        # save checkpoint file to resume training
-        save_path = str(dir_to_save + '/' + ('chkpt_%d.pt' % epoch))
-        torch.save({
-            'model': model.state_dict(),
-            'optimizer': optimizer.state_dict(),
-            'epoch': epoch
-        }, save_path)
-
-        # Validation
-        vali_loss, vali_pesq, vali_stoi = \
-            estimator(model, validation_loader, writer, dir_to_save, epoch, DEVICE)
+    # Validation
+    vali_loss, vali_sub_losses, vali_pesq, vali_stoi = \
+        validate(train_model, validation_loader, writer, dir_to_save, epoch, DEVICE, step)
+    if main_process:
         # write the loss on tensorboard
         writer.log_loss(train_loss, vali_loss, epoch)
         writer.log_score(vali_pesq, vali_stoi, epoch)
 
         print('Epoch [{}] | T {:.6f} | V {:.6} takes {:.2f} seconds\n'
               .format(epoch, train_loss, vali_loss, time.time() - start_time))
-        print('          | V PESQ: {:.6f} | STOI: {:.6f} '.format(vali_pesq, vali_stoi))
         # log file save
         fp.write('Epoch [{}] | T {:.6f} | V {:.6} takes {:.2f} seconds\n'
                  .format(epoch, train_loss, vali_loss, time.time() - start_time))
+        if cfg.perceptual is not False:  # train with perceptual loss function
+            writer.log_sub_loss(train_sub_losses['main'], train_sub_losses['perceptual'],
+                                vali_sub_losses['main'], vali_sub_losses['perceptual'], epoch)
+            print('          | T {:.6f} {:.6f} | V {:.6} {:.6f}'
+                  .format(train_sub_losses['main'], train_sub_losses['perceptual'],
+                          vali_sub_losses['main'], vali_sub_losses['perceptual']))
+            fp.write('          | T {:.6f} {:.6f} | V {:.6} {:.6f}\n'
+                     .format(train_sub_losses['main'], train_sub_losses['perceptual'],
+                             vali_sub_losses['main'], vali_sub_losses['perceptual']))
+        print('          | V PESQ: {:.6f} | STOI: {:.6f} '.format(vali_pesq, vali_stoi))
         fp.write('          | V PESQ: {:.6f} | STOI: {:.6f} \n'.format(vali_pesq, vali_stoi))
 
         mse_vali_total[epoch - 1] = vali_loss
         np.save(str(dir_to_save + '/mse_vali_total.npy'), mse_vali_total)
 
 fp.close()
-print('Training has been finished.')
-
-# Copy optimum model that has minimum MSE.
-print('Save optimum models...')
-min_index = np.argmin(mse_vali_total)
-print('Minimum validation loss is at ' + str(min_index + 1) + '.')
-src_file = str(dir_to_save + '/' + ('chkpt_%d.pt' % (min_index + 1)))
-tgt_file = str(dir_to_save + '/chkpt_opt.pt')
-shutil.copy(src_file, tgt_file)
+if main_process:
+    print('Training has been finished.')
+
+    # Copy optimum model that has minimum MSE.
+    print('Save optimum models...')
+    min_index = np.argmin(mse_vali_total)
+    print('Minimum validation loss is at ' + str(min_index + 1) + '.')
+    src_file = str(dir_to_save + '/' + ('chkpt_%d.pt' % (min_index + 1)))
+    tgt_file = str(dir_to_save + '/chkpt_opt.pt')
+    shutil.copy(src_file, tgt_file)
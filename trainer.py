@@ -1,283 +1,280 @@
 """
 Where the model is actually trained and validated
+
+One engine (train, validate) for every model. What differs between the models
+(the forward and the loss) is a "step" function, chosen from config by create_step():
+    step(model, inputs, targets, lengths, estimate=False) => loss, sub_losses, outputs
+    sub_losses: dict of the partial losses to log (e.g. main / perceptual)
+    outputs: the estimated wavs (only needed with estimate=True, for pesq and stoi)
+The engine owns the rest: device transfer, augmentation, mixed precision,
+gradient accumulation, compilation and the aggregation of the losses and scores.
 """
 
 import torch
-import numpy as np
+from contextlib import nullcontext
+import config as cfg
 import tools_for_model as tools
+from tools_for_augmentation import create_augmentation
 from tools_for_estimate import cal_pesq, cal_stoi
+from tools_for_loss import padding_mask, frame_lengths
+from tools_for_distributed import unwrap, reduce_sum, reduce_mean, get_rank
 
 
 #######################################################################
-#                             For train                               #
+#                               Setting                               #
 #######################################################################
-# T-F masking
-def model_train(model, optimizer, train_loader, DEVICE):
-    # initialization
-    train_loss = 0
-    batch_num = 0
-
-    # arr = []
-    # train
-    model.train()
-    for inputs, targets in tools.Bar(train_loader):
-        batch_num += 1
-
-        # to cuda
-        inputs = inputs.float().to(DEVICE)
-        targets = targets.float().to(DEVICE)
-
-        _, _, outputs = model(inputs, targets)
-        loss = model.loss(outputs, targets)
-        # # if you want to check the scale of the loss
-        # print('loss: {:.4}'.format(loss))
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss
-    train_loss /= batch_num
-
-    return train_loss 
-
-
-def model_perceptual_train(model, optimizer, train_loader, DEVICE):
-    # initialization
-    train_loss = 0
-    train_main_loss = 0
-    train_perceptual_loss = 0
-    batch_num = 0
-
-    # train
-    model.train()
-    for inputs, targets in tools.Bar(train_loader):
-        batch_num += 1
-
-        # to cuda
-        inputs = inputs.float().to(DEVICE)
-        targets = targets.float().to(DEVICE)
-
-        real_spec, img_spec, outputs = model(inputs)
-        main_loss = model.loss(outputs, targets)
-        perceptual_loss = model.loss(outputs, targets, real_spec, img_spec, perceptual=True)
-
-        # the constraint ratio 
-        r1 = 1
-        r2 = 1
-        r3 = r1 + r2
-        loss = (r1 * main_loss + r2 * perceptual_loss) / r3
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss
-        train_main_loss += r1 * main_loss
-        train_perceptual_loss += r2 * perceptual_loss
-    train_loss /= batch_num
-    train_main_loss /= batch_num
-    train_perceptual_loss /= batch_num
-
-    return train_loss, train_main_loss, train_perceptual_loss
-
-
-def fullsubnet_train(model, optimizer, train_loader, DEVICE):
-    # initialization
-    train_loss = 0
-    batch_num = 0
+# augmentation on DEVICE (if not, it is done in the dataloader)
+augmentation = create_augmentation() if cfg.augment_on_device else None
 
-    # arr = []
-    # train
-    model.train()
-    for inputs, targets in tools.Bar(train_loader):
-        batch_num += 1
+# mixed precision: the forward and the loss run under autocast,
+# and the gradient scaler keeps the float16 gradients from underflowing (not needed for bfloat16)
+AMP_DTYPE = getattr(torch, cfg.amp_dtype)
+scaler = torch.amp.GradScaler('cuda', enabled=cfg.amp and AMP_DTYPE == torch.float16 and torch.device(cfg.DEVICE).type == 'cuda')
 
-        # to cuda
-        inputs = inputs.float().to(DEVICE)
-        targets = targets.float().to(DEVICE)
 
-        noisy_complex = tools.stft(inputs)
-        clean_complex = tools.stft(targets)
+def autocast(DEVICE):
+    return torch.autocast(torch.device(DEVICE).type, dtype=AMP_DTYPE, enabled=cfg.amp)
 
-        noisy_mag, _ = tools.mag_phase(noisy_complex)
-        cIRM = tools.build_complex_ideal_ratio_mask(noisy_complex, clean_complex)
 
-        cRM = model(noisy_mag)
-        loss = model.loss(cIRM, cRM)
-        # # if you want to check the scale of the loss
-        # print('loss: {:.4}'.format(loss))
+# masks of the padding (see dataloader.pad_collate), None if nothing is padded (lengths None)
+def wav_mask(lengths, wavs):
+    # [B, T]
+    return padding_mask(lengths, wavs.size(-1))
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
 
-        train_loss += loss
-    train_loss /= batch_num
+def conv_stft_mask(lengths, specs):
+    # [B, 1, T] frames of ConvSTFT (DCCRN, CRN), broadcast over the frequency
+    if lengths is None:
+        return None
+    mask = padding_mask(frame_lengths(lengths, cfg.win_inc, cfg.win_len - cfg.win_inc), specs.size(-1))
+    return mask[:, None, :]
 
-    return train_loss
 
+def stft_mask(lengths, cRM):
+    # [B, 1, T, 1] frames of tools.stft (FullSubNet), broadcast over the frequency and real/imag
+    if lengths is None:
+        return None
+    mask = padding_mask(frame_lengths(lengths, int(cfg.win_len * cfg.ola_ratio), cfg.fft_len // 2), cRM.size(-2))
+    return mask[:, None, :, None]
 
-# Spectral mapping
-def dccrn_direct_train(model, optimizer, train_loader, DEVICE):
-    # initialization
-    train_loss = 0
-    batch_num = 0
 
-    # train
-    model.train()
-    for inputs, targets in tools.Bar(train_loader):
-        batch_num += 1
+def trim(wavs, lengths):
+    # numpy wavs without the padding, for pesq and stoi
+    wavs = wavs.cpu().detach().numpy()
+    if lengths is None:
+        return list(wavs)
+    return [wav[:length] for wav, length in zip(wavs, lengths.tolist())]
 
-        # to cuda
-        inputs = inputs.float().to(DEVICE)
-        targets = targets.float().to(DEVICE)
 
-        output_real, target_real, output_imag, target_imag, _ = model(inputs, targets)
-        real_loss = model.loss(output_real, target_real)
-        imag_loss = model.loss(output_imag, target_imag)
-        loss = (real_loss + imag_loss) / 2
+def to_device(inputs, targets, lengths, DEVICE):
+    # non_blocking: the copy from the pinned memory overlaps the computation
+    # lengths: None if nothing is padded, decided here on the CPU lengths (no host sync in the steps)
+    inputs = inputs.float().to(DEVICE, non_blocking=True)
+    targets = targets.float().to(DEVICE, non_blocking=True)
+    if lengths is None or bool(torch.all(lengths >= inputs.size(-1))):
+        return inputs, targets, None
+    lengths = lengths.to(DEVICE, non_blocking=True)
+    return inputs, targets, lengths
 
-        # # if you want to check the scale of the loss
-        # print('loss: {:.4}'.format(loss))
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+def compile_model(model):
+    # torch.compile (cfg.torch_compile), the parameters and the state_dict are shared with the model
+    if cfg.torch_compile:
+        return torch.compile(model)
+    return model
 
-        train_loss += loss
-    train_loss /= batch_num
 
-    return train_loss
+#######################################################################
+#                                Steps                                #
+#######################################################################
+# T-F masking (DCCRN, CRN)
+def masking_step(model, inputs, targets, lengths, estimate=False):
+    outputs = model(inputs)[-1]
+    loss = unwrap(model).loss(outputs, targets, mask=wav_mask(lengths, outputs))
+    return loss, {}, outputs
+
+
+# T-F masking with the perceptual loss
+def perceptual_step(model, inputs, targets, lengths, estimate=False):
+    # DCCRN: (real, imag, wav), CRN: (mags, wav)
+    *specs, outputs = model(inputs)
+    mask = wav_mask(lengths, outputs)
+    main_loss = unwrap(model).loss(outputs, targets, mask=mask)
+    # PMSQE: on the wavs of whole seconds (see dataloader.length_multiple), the padding of the outputs is zeroed
+    perceptual_loss = unwrap(model).loss(outputs if mask is None else outputs * mask, targets, *specs,
+                                         perceptual=True)
+
+    # the constraint ratio
+    r1 = 1
+    r2 = 1
+    r3 = r1 + r2
+    loss = (r1 * main_loss + r2 * perceptual_loss) / r3
+    return loss, {'main': r1 * main_loss, 'perceptual': r2 * perceptual_loss}, outputs
+
+
+# cIRM (FullSubNet)
+def fullsubnet_step(model, inputs, targets, lengths, estimate=False):
+    noisy_complex = tools.stft(inputs)
+    clean_complex = tools.stft(targets)
+
+    noisy_mag, _ = tools.mag_phase(noisy_complex)
+    cIRM = tools.build_complex_ideal_ratio_mask(noisy_complex, clean_complex)
+
+    # the number of valid frames: the offline norms of the model leave out the padding
+    num_frames = None
+    if lengths is not None:
+        num_frames = frame_lengths(lengths, int(cfg.win_len * cfg.ola_ratio), cfg.fft_len // 2)
+
+    # frequency subsampling in training (cfg.sb_freq_ratio): the loss only on the freqs of the sub-band model
+    freqs = unwrap(model).sample_freqs(noisy_mag)
+    if freqs is not None:
+        cRM = model(noisy_mag, freqs, num_frames)
+        loss = unwrap(model).loss(unwrap(model).select_freqs(cIRM, freqs), cRM, mask=stft_mask(lengths, cRM))
+        return loss, {}, None
+
+    cRM = model(noisy_mag, None, num_frames)
+    loss = unwrap(model).loss(cIRM, cRM, mask=stft_mask(lengths, cRM))
+    if not estimate:
+        return loss, {}, None
+
+    # the enhanced speech
+    cRM = tools.decompress_cIRM(cRM)
+    enhanced_real = cRM[..., 0] * noisy_complex.real - cRM[..., 1] * noisy_complex.imag
+    enhanced_imag = cRM[..., 1] * noisy_complex.real + cRM[..., 0] * noisy_complex.imag
+    enhanced_complex = torch.stack((enhanced_real, enhanced_imag), dim=-1)
+    outputs = tools.istft(enhanced_complex, length=inputs.size(-1))
+    return loss, {}, outputs
+
+
+# Spectral mapping (DCCRN)
+def dccrn_direct_step(model, inputs, targets, lengths, estimate=False):
+    output_real, output_imag, outputs = model(inputs)
+    target_real, target_imag = unwrap(model).target_spec(targets)
+    mask = conv_stft_mask(lengths, output_real)
+    real_loss = unwrap(model).loss(output_real, target_real, mask=mask)
+    imag_loss = unwrap(model).loss(output_imag, target_imag, mask=mask)
+    loss = (real_loss + imag_loss) / 2
+    return loss, {}, outputs
+
+
+# Spectral mapping (CRN)
+def crn_direct_step(model, inputs, targets, lengths, estimate=False):
+    output_mag, outputs = model(inputs)
+    target_mag = unwrap(model).target_spec(targets)
+    loss = unwrap(model).loss(output_mag, target_mag, mask=conv_stft_mask(lengths, output_mag))
+    return loss, {}, outputs
+
+
+def create_step():
+    """the step of the current setting (config)"""
+    if cfg.perceptual is not False:
+        return perceptual_step
+    elif cfg.model == 'FullSubNet':
+        return fullsubnet_step
+    elif cfg.masking_mode == 'Direct(None make)' and cfg.model == 'DCCRN':
+        return dccrn_direct_step
+    elif cfg.masking_mode == 'Direct(None make)' and cfg.model == 'CRN':
+        return crn_direct_step
+    else:
+        return masking_step
+
+
+def add_losses(total, sub_losses):
+    for name, loss in sub_losses.items():
+        total[name] = total.get(name, 0) + loss.detach()
+    return total
 
 
-def crn_direct_train(model, optimizer, train_loader, DEVICE):
+#######################################################################
+#                             For train                               #
+#######################################################################
+def train(model, optimizer, train_loader, DEVICE, step):
+    """
+    One epoch of the training.
+    Returns the mean loss and the dict of the mean sub losses
+    """
     # initialization
     train_loss = 0
+    train_sub_losses = {}
     batch_num = 0
 
     # train
     model.train()
-    for inputs, targets in tools.Bar(train_loader):
+    optimizer.zero_grad()  # (the gradients of an incomplete accumulation at the end of the last epoch are dropped)
+    for inputs, targets, lengths in tools.Bar(train_loader):
         batch_num += 1
 
         # to cuda
-        inputs = inputs.float().to(DEVICE)
-        targets = targets.float().to(DEVICE)
-
-        output_mag, target_mag, _ = model(inputs, targets)
-        loss = model.loss(output_mag, target_mag)
-
-        # # if you want to check the scale of the loss
-        # print('loss: {:.4}'.format(loss))
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss
-    train_loss /= batch_num
-
-    return train_loss
+        inputs, targets, lengths = to_device(inputs, targets, lengths, DEVICE)
+        if augmentation is not None:
+            inputs, targets = augmentation(inputs, targets, lengths)
+
+        # gradient accumulation: the loss of each micro-batch is divided by the number of micro-batches,
+        # and the parameters are updated once every cfg.accumulation_steps micro-batches
+        update = batch_num % cfg.accumulation_steps == 0
+        # (distributed: the gradients are synchronized only for the update)
+        sync = nullcontext() if update or not hasattr(model, 'no_sync') else model.no_sync()
+        with sync:
+            with autocast(DEVICE):
+                loss, sub_losses, _ = step(model, inputs, targets, lengths)
+                # # if you want to check the scale of the loss
+                # print('loss: {:.4}'.format(loss))
+            scaler.scale(loss / cfg.accumulation_steps).backward()
+
+        if update:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+
+        train_loss += loss.detach()
+        add_losses(train_sub_losses, sub_losses)
+    # mean over all the processes (distributed)
+    train_loss = reduce_mean(train_loss / batch_num)
+    train_sub_losses = {name: reduce_mean(loss / batch_num) for name, loss in train_sub_losses.items()}
+
+    return train_loss, train_sub_losses
 
 
 #######################################################################
 #                           For validation                            #
 #######################################################################
-# T-F masking
-def model_validate(model, validation_loader, writer, dir_to_save, epoch, DEVICE):
-    # initialization
-    validation_loss = 0
-    batch_num = 0
-
-    avg_pesq = 0
-    avg_stoi = 0
-
-    # for record the score each samples
-    f_score = open(dir_to_save + '/Epoch_' + '%d_SCORES' % epoch, 'a')
-
-    model.eval()
-    with torch.no_grad():
-        for inputs, targets in tools.Bar(validation_loader):
-            batch_num += 1
-
-            # to cuda
-            inputs = inputs.float().to(DEVICE)
-            targets = targets.float().to(DEVICE)
-
-            _, _, outputs = model(inputs, targets)
-            loss = model.loss(outputs, targets)
-
-            validation_loss += loss
-
-            # estimate the output speech with pesq and stoi
-            estimated_wavs = outputs.cpu().detach().numpy()
-            clean_wavs = targets.cpu().detach().numpy()
-
-            pesq = cal_pesq(estimated_wavs, clean_wavs)
-            stoi = cal_stoi(estimated_wavs, clean_wavs)
-
-            # pesq: 0.1 better / stoi: 0.01 better
-            for i in range(len(pesq)):
-                f_score.write('PESQ {:.6f} | STOI {:.6f}\n'.format(pesq[i], stoi[i]))
-
-            # reshape for sum
-            pesq = np.reshape(pesq, (1, -1))
-            stoi = np.reshape(stoi, (1, -1))
-
-            avg_pesq += sum(pesq[0]) / len(inputs)
-            avg_stoi += sum(stoi[0]) / len(inputs)
-
-        # save the samples to tensorboard
-        if epoch % 10 == 0:
-            writer.log_wav(inputs[0], targets[0], outputs[0], epoch)
-
-        validation_loss /= batch_num
-        avg_pesq /= batch_num
-        avg_stoi /= batch_num
-
-        return validation_loss, avg_pesq, avg_stoi
-    
-    
-def model_perceptual_validate(model, validation_loader, writer, dir_to_save, epoch, DEVICE):
+def validate(model, validation_loader, writer, dir_to_save, epoch, DEVICE, step):
+    """
+    Validation, with pesq and stoi of each sample (recorded in 'Epoch_N_SCORES').
+    writer: tensorboard Writer (None: no samples are saved, e.g. the processes other than rank 0)
+    Returns the mean loss, the dict of the mean sub losses, the mean pesq and stoi
+    """
     # initialization
     validation_loss = 0
-    validation_main_loss = 0
-    validation_perceptual_loss = 0
+    validation_sub_losses = {}
     batch_num = 0
 
-    avg_pesq = 0
-    avg_stoi = 0
+    total_pesq = 0
+    total_stoi = 0
+    sample_num = 0
 
-    # for record the score each samples
-    f_score = open(dir_to_save + '/Epoch_' + '%d_SCORES' % epoch, 'a')
+    # for record the score each samples (distributed: a file for each process)
+    score_path = dir_to_save + '/Epoch_' + '%d_SCORES' % epoch
+    if get_rank() > 0:
+        score_path += '_rank%d' % get_rank()
+    f_score = open(score_path, 'a')
 
     model.eval()
     with torch.no_grad():
-        for inputs, targets in tools.Bar(validation_loader):
+        for inputs, targets, lengths in tools.Bar(validation_loader):
             batch_num += 1
 
             # to cuda
-            inputs = inputs.float().to(DEVICE)
-            targets = targets.float().to(DEVICE)
+            inputs, targets, lengths = to_device(inputs, targets, lengths, DEVICE)
 
-            real_spec, img_spec, outputs = model(inputs)
-            main_loss = model.loss(outputs, targets)
-            perceptual_loss = model.loss(outputs, targets, real_spec, img_spec, perceptual=True)
-
-            # the constraint ratio
-            r1 = 1
-            r2 = 1
-            r3 = r1 + r2
-            loss = (r1 * main_loss + r2 * perceptual_loss) / r3
+            loss, sub_losses, outputs = step(model, inputs, targets, lengths, estimate=True)
 
             validation_loss += loss
-            validation_main_loss += r1 * main_loss
-            validation_perceptual_loss += r2 * perceptual_loss
+            add_losses(validation_sub_losses, sub_losses)
 
             # estimate the output speech with pesq and stoi
-            estimated_wavs = outputs.cpu().detach().numpy()
-            clean_wavs = targets.cpu().detach().numpy()
+            estimated_wavs = trim(outputs, lengths)
+            clean_wavs = trim(targets, lengths)
 
             pesq = cal_pesq(estimated_wavs, clean_wavs)
             stoi = cal_stoi(estimated_wavs, clean_wavs)
@@ -286,198 +283,22 @@ def model_perceptual_validate(model, validation_loader, writer, dir_to_save, epo
             for i in range(len(pesq)):
                 f_score.write('PESQ {:.6f} | STOI {:.6f}\n'.format(pesq[i], stoi[i]))
 
-            # reshape for sum
-            pesq = np.reshape(pesq, (1, -1))
-            stoi = np.reshape(stoi, (1, -1))
-
-            avg_pesq += sum(pesq[0]) / len(inputs)
-            avg_stoi += sum(stoi[0]) / len(inputs)
+            total_pesq += sum(pesq)
+            total_stoi += sum(stoi)
+            sample_num += len(pesq)
 
         # save the samples to tensorboard
-        if epoch % 10 == 0:
-            writer.log_wav(inputs[0], targets[0], outputs[0], epoch)
+        if epoch % 10 == 0 and writer is not None:
+            length = inputs.size(-1) if lengths is None else int(lengths[0])
+            writer.log_wav(inputs[0, :length], targets[0, :length], outputs[0, :length], epoch)
 
-        validation_loss /= batch_num
-        validation_main_loss /= batch_num
-        validation_perceptual_loss /= batch_num
-        avg_pesq /= batch_num
-        avg_stoi /= batch_num
+    f_score.close()
 
-        return validation_loss, validation_main_loss, validation_perceptual_loss, avg_pesq, avg_stoi
+    # mean over all the processes (distributed)
+    validation_loss = reduce_mean(validation_loss / batch_num)
+    validation_sub_losses = {name: reduce_mean(loss / batch_num) for name, loss in validation_sub_losses.items()}
+    sample_num = reduce_sum(sample_num)
+    avg_pesq = reduce_sum(total_pesq) / sample_num
+    avg_stoi = reduce_sum(total_stoi) / sample_num
 
-
-def fullsubnet_validate(model, validation_loader, writer, dir_to_save, epoch, DEVICE):
-    # initialization
-    validation_loss = 0
-    batch_num = 0
-
-    avg_pesq = 0
-    avg_stoi = 0
-
-    # for record the score each samples
-    f_score = open(dir_to_save + '/Epoch_' + '%d_SCORES' % epoch, 'a')
-
-    model.eval()
-    with torch.no_grad():
-        for inputs, targets in tools.Bar(validation_loader):
-            batch_num += 1
-
-            # to cuda
-            inputs = inputs.float().to(DEVICE)
-            targets = targets.float().to(DEVICE)
-
-            noisy_complex = tools.stft(inputs)
-            clean_complex = tools.stft(targets)
-
-            noisy_mag, _ = tools.mag_phase(noisy_complex)
-            cIRM = tools.build_complex_ideal_ratio_mask(noisy_complex, clean_complex)
-
-            cRM = model(noisy_mag)
-            loss = model.loss(cIRM, cRM)
-
-            validation_loss += loss
-
-            # estimate the output speech with pesq and stoi
-            cRM = tools.decompress_cIRM(cRM)
-            enhanced_real = cRM[..., 0] * noisy_complex.real - cRM[..., 1] * noisy_complex.imag
-            enhanced_imag = cRM[..., 1] * noisy_complex.real + cRM[..., 0] * noisy_complex.imag
-            enhanced_complex = torch.stack((enhanced_real, enhanced_imag), dim=-1)
-            enhanced_outputs = tools.istft(enhanced_complex, length=inputs.size(-1))
-
-            estimated_wavs = enhanced_outputs.cpu().detach().numpy()
-            clean_wavs = targets.cpu().detach().numpy()
-
-            pesq = cal_pesq(estimated_wavs, clean_wavs)
-            stoi = cal_stoi(estimated_wavs, clean_wavs)
-
-            # pesq: 0.1 better / stoi: 0.01 better
-            for i in range(len(pesq)):
-                f_score.write('PESQ {:.6f} | STOI {:.6f}\n'.format(pesq[i], stoi[i]))
-
-            # reshape for sum
-            pesq = np.reshape(pesq, (1, -1))
-            stoi = np.reshape(stoi, (1, -1))
-
-            avg_pesq += sum(pesq[0]) / len(inputs)
-            avg_stoi += sum(stoi[0]) / len(inputs)
-
-        # save the samples to tensorboard
-        if epoch % 10 == 0:
-            writer.log_wav(inputs[0], targets[0], enhanced_outputs[0], epoch)
-
-        validation_loss /= batch_num
-        avg_pesq /= batch_num
-        avg_stoi /= batch_num
-
-        return validation_loss, avg_pesq, avg_stoi
-    
-    
-# Spectral mapping
-def dccrn_direct_validate(model, validation_loader, writer, dir_to_save, epoch, DEVICE):
-    # initialization
-    validation_loss = 0
-    batch_num = 0
-
-    avg_pesq = 0
-    avg_stoi = 0
-
-    # for record the score each samples
-    f_score = open(dir_to_save + '/Epoch_' + '%d_SCORES' % epoch, 'a')
-
-    model.eval()
-    with torch.no_grad():
-        for inputs, targets in tools.Bar(validation_loader):
-            batch_num += 1
-
-            # to cuda
-            inputs = inputs.float().to(DEVICE)
-            targets = targets.float().to(DEVICE)
-
-            output_real, target_real, output_imag, target_imag, outputs = model(inputs, targets)
-            real_loss = model.loss(output_real, target_real)
-            imag_loss = model.loss(output_imag, target_imag)
-            loss = (real_loss + imag_loss) / 2
-
-            validation_loss += loss
-
-            # estimate the output speech with pesq and stoi
-            estimated_wavs = outputs.cpu().detach().numpy()
-            clean_wavs = targets.cpu().detach().numpy()
-
-            pesq = cal_pesq(estimated_wavs, clean_wavs)
-            stoi = cal_stoi(estimated_wavs, clean_wavs)
-
-            # pesq: 0.1 better / stoi: 0.01 better
-            for i in range(len(pesq)):
-                f_score.write('PESQ {:.6f} | STOI {:.6f}\n'.format(pesq[i], stoi[i]))
-
-            # reshape for sum
-            pesq = np.reshape(pesq, (1, -1))
-            stoi = np.reshape(stoi, (1, -1))
-
-            avg_pesq += sum(pesq[0]) / len(inputs)
-            avg_stoi += sum(stoi[0]) / len(inputs)
-
-        # save the samples to tensorboard
-        if epoch % 10 == 0:
-            writer.log_wav(inputs[0], targets[0], outputs[0], epoch)
-                
-        validation_loss /= batch_num
-        avg_pesq /= batch_num
-        avg_stoi /= batch_num
-
-        return validation_loss, avg_pesq, avg_stoi
-    
-
-def crn_direct_validate(model, validation_loader, writer, dir_to_save, epoch, DEVICE):
-    # initialization
-    validation_loss = 0
-    batch_num = 0
-
-    avg_pesq = 0
-    avg_stoi = 0
-
-    # for record the score each samples
-    f_score = open(dir_to_save + '/Epoch_' + '%d_SCORES' % epoch, 'a')
-
-    model.eval()
-    with torch.no_grad():
-        for inputs, targets in tools.Bar(validation_loader):
-            batch_num += 1
-
-            # to cuda
-            inputs = inputs.float().to(DEVICE)
-            targets = targets.float().to(DEVICE)
-
-            output_mag, target_mag, outputs = model(inputs, targets)
-            loss = model.loss(output_mag, target_mag)
-
-            validation_loss += loss
-
-            # estimate the output speech with pesq and stoi
-            estimated_wavs = outputs.cpu().detach().numpy()
-            clean_wavs = targets.cpu().detach().numpy()
-
-            pesq = cal_pesq(estimated_wavs, clean_wavs)
-            stoi = cal_stoi(estimated_wavs, clean_wavs)
-
-            # pesq: 0.1 better / stoi: 0.01 better
-            for i in range(len(pesq)):
-                f_score.write('PESQ {:.6f} | STOI {:.6f}\n'.format(pesq[i], stoi[i]))
-
-            # reshape for sum
-            pesq = np.reshape(pesq, (1, -1))
-            stoi = np.reshape(stoi, (1, -1))
-
-            avg_pesq += sum(pesq[0]) / len(inputs)
-            avg_stoi += sum(stoi[0]) / len(inputs)
-
-        # save the samples to tensorboard
-        if epoch % 10 == 0:
-            writer.log_wav(inputs[0], targets[0], outputs[0], epoch)
-                
-        validation_loss /= batch_num
-        avg_pesq /= batch_num
-        avg_stoi /= batch_num
-
-        return validation_loss, avg_pesq, avg_stoi
+    return validation_loss, validation_sub_losses, avg_pesq, avg_stoi
@@ -0,0 +1,50 @@
+"""
+convert a directory of clean speech or noise wav files to a sharded corpus (see tools_for_dataset.py)
+
+Every file is decoded, down-mixed to mono and resampled once, and stored as float32 samples.
+The corpora are used by the on-the-fly mixture dataset (config.mixture = True).
+
+    python wav_to_corpus.py './Dataset/train/clean' './Dataset/train_clean_corpus' 16000
+    python wav_to_corpus.py './Dataset/train/noise' './Dataset/train_noise_corpus' 16000
+"""
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from generate_noisy_data import scan_directory, read_wav
+from tools_for_dataset import ShardWriter
+
+
+def read_item(addr, fs):
+    return str(addr), read_wav(addr, fs)
+
+
+def convert(wav_dir, dataset_dir, fs, num_workers=cpu_count()):
+    with ShardWriter(dataset_dir, streams=('samples',)) as writer:
+        done = writer.keys()
+        list_files = [addr for addr in scan_directory(wav_dir) if str(addr) not in done]
+        print('{} files are already converted, {} files to go...'.format(len(done), len(list_files)))
+
+        st_time = time.time()
+        with Pool(num_workers) as pool:
+            for key, wav in pool.imap(partial(read_item, fs=fs), list_files, chunksize=16):
+                writer.add(key, wav)
+    print('{} files are converted... takes {:.4} seconds...'.format(len(list_files), time.time() - st_time))
+
+
+def main():
+    argvs = sys.argv[1:]
+    if len(argvs) not in (3, 4):
+        print('Error: Invalid input arguments')
+        print('\t Usage: python wav_to_corpus.py [wav_dir] [dataset_dir] [fs] [workers]')
+        print("\t\t [wav_dir]: './Dataset/train/clean', './Dataset/train/noise', ...")
+        print("\t\t [dataset_dir]: './Dataset/train_clean_corpus', ...")
+        print("\t\t [fs]: '16000', ...")
+        print("\t\t [workers]: number of processes (default: number of cores)")
+        exit()
+    num_workers = int(argvs[3]) if len(argvs) > 3 else cpu_count()
+    convert(argvs[0], argvs[1], int(argvs[2]), num_workers=num_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+convert noisy/clean wav pairs to the sharded dataset format (see tools_for_dataset.py)
+
+It replaces wav_to_numpy.py, wav_to_numpy_aug.py and wav_to_numpy_validation.py.
+The files are decoded and normalized in a process pool and written shard by shard,
+so the whole dataset never has to be in memory.
+The pairs are read from the manifest of generate_noisy_data.py (manifest.csv in the noisy directory)
+if there is one, otherwise they are found by the file names.
+The pairs that are already in the dataset are skipped, so an interrupted run can be started again.
+
+    python wav_to_shard.py './Dataset/train/noisy' './Dataset/train/clean' './Dataset/train_dataset_norm_tv31_snr51015'
+    python wav_to_shard.py './Dataset/train/noisy_aug' './Dataset/train/clean_aug' './Dataset/train_dataset_norm_tv31_snr51015_minus'
+    python wav_to_shard.py './Dataset/validation/noisy' './Dataset/validation/clean' './Dataset/validation_dataset_norm_tv31_snr51015'
+"""
+import os
+import sys
+import time
+import soundfile
+from pathlib import Path
+from multiprocessing import Pool, cpu_count
+from generate_noisy_data import scan_directory
+from tools_for_dataset import ShardWriter, normalization, MIXTURE_MANIFEST_NAME, read_mixture_manifest
+
+
+def build_clean_index(clean_dir):
+    """name of the clean file (without '.wav') -> address"""
+    return {Path(addr).stem: addr for addr in scan_directory(clean_dir)}
+
+
+def find_clean(noisy_addr, clean_index):
+    # noisy data name = clean name + '_' + noise name + '_' + snr
+    # so, find the longest '_' separated prefix of the noisy name that is a clean name
+    parts = Path(noisy_addr).stem.split('_')
+    for idx in range(len(parts) - 1, 0, -1):
+        clean_name = '_'.join(parts[:idx])
+        if clean_name in clean_index:
+            return clean_index[clean_name]
+    return None
+
+
+def read_pair(pair):
+    noisy_addr, clean_addr = pair
+    data_noisy, _ = soundfile.read(noisy_addr, dtype='float32')
+    data_clean, _ = soundfile.read(clean_addr, dtype='float32')
+    return str(noisy_addr), normalization(data_noisy), normalization(data_clean)
+
+
+def find_pairs(noisy_dir, clean_dir):
+    """[(noisy address, clean address)]
+    from the manifest written by generate_noisy_data.py, or by scanning the directories if there is no manifest.
+    """
+    manifest_path = os.path.join(str(noisy_dir), MIXTURE_MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        print('Read the pairs from %s' % manifest_path)
+        return [(row['noisy'], row['clean']) for row in read_mixture_manifest(manifest_path)]
+
+    clean_index = build_clean_index(clean_dir)
+    pairs = []
+    for noisy_addr in scan_directory(noisy_dir):
+        clean_addr = find_clean(noisy_addr, clean_index)
+        if clean_addr is None:
+            print('[Warning] There is no clean data for %s' % noisy_addr)
+            continue
+        pairs.append((noisy_addr, clean_addr))
+    return pairs
+
+
+def convert(noisy_dir, clean_dir, dataset_dir, num_workers=cpu_count(), dtype='float32'):
+    with ShardWriter(dataset_dir, dtype=dtype) as writer:
+        done = writer.keys()
+        pairs = [(noisy_addr, clean_addr) for noisy_addr, clean_addr in find_pairs(noisy_dir, clean_dir)
+                 if str(noisy_addr) not in done]
+        print('{} pairs are already converted, {} pairs to go...'.format(len(done), len(pairs)))
+
+        st_time = time.time()
+        with Pool(num_workers) as pool:
+            for batch, (key, data_noisy, data_clean) in enumerate(pool.imap(read_pair, pairs, chunksize=16)):
+                writer.add(key, data_noisy, data_clean)
+                if (batch + 1) % 100 == 0:
+                    print('{} done... takes {:.4} seconds...'.format(batch + 1, time.time() - st_time))
+    print('{} pairs are converted... takes {:.4} seconds...'.format(len(pairs), time.time() - st_time))
+
+
+def main():
+    argvs = sys.argv[1:]
+    if len(argvs) not in (3, 4, 5):
+        print('Error: Invalid input arguments')
+        print('\t Usage: python wav_to_shard.py [noisy_dir] [clean_dir] [dataset_dir] [workers] [dtype]')
+        print("\t\t [noisy_dir]: './Dataset/train/noisy', ...")
+        print("\t\t [clean_dir]: './Dataset/train/clean', ...")
+        print("\t\t [dataset_dir]: './Dataset/train_dataset_norm_tv31_snr51015', ...")
+        print("\t\t [workers]: number of processes (default: number of cores)")
+        print("\t\t [dtype]: 'float32' (default), 'int16'")
+        exit()
+    num_workers = int(argvs[3]) if len(argvs) > 3 else cpu_count()
+    dtype = argvs[4] if len(argvs) > 4 else 'float32'
+    convert(argvs[0], argvs[1], argvs[2], num_workers=num_workers, dtype=dtype)
+
+
+if __name__ == '__main__':
+    main()